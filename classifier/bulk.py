@@ -0,0 +1,236 @@
+#!/bin/python
+"""
+Bulk classification of a photo directory.
+
+Walks a directory tree, classifies every jpg with Predicter_NN on all the
+cores and streams one JSON line per picture to the output file:
+
+  {"file": ".../20150417_2207_00.jpg", "closed": false, "confidence": 0.12,
+   "version": "NThetasV7.mat@20150420_101500.250000-3f2a9c1e",
+   "moved_to": ".../open/20150417_2207_00.jpg"}
+
+The output file is the checkpoint. It is appended to and flushed after
+every batch, and the pictures already in it are skipped when the command
+is run again, so an interrupted run resumes where it stopped. Pictures
+that failed get an "error" line and are retried on the next run.
+
+  python -m classifier.bulk --day_model ThetasV7.mat --night_model NThetasV7.mat \
+      /data/pictures --out pictures.jsonl --organize
+"""
+import common.log as logging
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+from itertools import imap
+from re import search
+from shutil import move
+from time import time
+
+import ingest
+import daylight
+import predict_NN
+
+logger = logging.getLogger()
+
+# predicter of the worker processes. Built before the pool forks so every
+# worker shares the resident models instead of loading its own
+_predicter = None
+
+# the jpgs under dirname, sorted, leaving out the skip directories
+def walk_pictures(dirname, skip=()):
+    skip = set(os.path.abspath(d) for d in skip)
+    for root, dirs, files in os.walk(dirname):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skip)
+        for name in sorted(files):
+            if search(r"(.+)\.jpg", name) is not None:
+                yield os.path.join(root, name)
+
+# move a picture to where its line says (see _record). Does nothing if it
+# is already there
+def _move(record):
+    target = record['moved_to']
+    if os.path.exists(target) or not os.path.exists(record['file']):
+        return
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    move(record['file'], target)
+
+# pictures recorded in the output file of an earlier run. A line cut off by
+# an interrupted write is dropped from the file, and a move the run was
+# interrupted before is finished
+def load_checkpoint(out_file):
+    done = set()
+    if not os.path.exists(out_file):
+        return done
+    with open(out_file, 'r+b') as f:
+        good = 0
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            good += len(line)
+            if 'error' not in record:
+                done.add(record['file'])
+            if 'moved_to' in record:
+                _move(record)
+        if good != f.tell():
+            logger.warning("Dropping a partial line at the end of " + out_file)
+            f.truncate(good)
+    return done
+
+def _init_worker():
+    # the parent handles ^C and stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# classify one batch of files in a worker. returns a list of
+# (filename, prediction or None)
+def _classify(filenames):
+    try:
+        results = _predicter.predict_batch(filenames)
+    except Exception as ex:
+        logger.error("Batch failed: " + str(ex))
+        results = [None] * len(filenames)
+    return zip(filenames, results)
+
+def _batches(filenames, batch_size):
+    batch = list()
+    for filename in filenames:
+        batch.append(filename)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if len(batch) > 0:
+        yield batch
+
+def _record(filename, result, dirname, open_dir):
+    if result is None:
+        return {'file': filename, 'error': 'not classified'}
+    record = {'file': filename,
+              'closed': bool(result[0]),
+              'confidence': float(result[1]),
+              'version': getattr(result, 'version', None)}
+    if open_dir is not None and not result[0]:
+        # moved by _move once the line is on disk. Subdirectories are kept,
+        # the same name may be used under two of them
+        record['moved_to'] = os.path.join(open_dir, os.path.relpath(filename, dirname))
+    return record
+
+# classify every jpg under dirname into out_file. predicter is a
+# Predicter_NN, workers the number of processes (1 runs in this process).
+# With organize, opened frames are moved to <dirname>/open like
+# predictImage.organize_pics, keeping their subdirectory. returns a dict of
+# counters
+def classify_tree(predicter, dirname, out_file, workers=None, batch_size=32, organize=False):
+    global _predicter
+    workers = workers or multiprocessing.cpu_count()
+    open_dir = None
+    if organize:
+        open_dir = os.path.join(dirname, 'open')
+        if not os.path.isdir(open_dir):
+            os.makedirs(open_dir)
+
+    done = load_checkpoint(out_file)
+    todo = (f for f in walk_pictures(dirname, [open_dir] if open_dir else ()) if f not in done)
+    stats = {'skipped': len(done), 'classified': 0, 'opened': 0, 'failed': 0}
+    if len(done) > 0:
+        logger.info("Resuming, %d pictures already in %s" % (len(done), out_file))
+
+    _predicter = predicter
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker)
+        results = pool.imap_unordered(_classify, _batches(todo, batch_size))
+    else:
+        results = imap(_classify, _batches(todo, batch_size))
+
+    start = time()
+    out = open(out_file, 'ab')
+    completed = False
+    try:
+        for batch in results:
+            records = [_record(filename, result, dirname, open_dir) for filename, result in batch]
+            for record in records:
+                out.write(json.dumps(record, sort_keys=True) + '\n')
+                if 'error' in record:
+                    stats['failed'] += 1
+                else:
+                    stats['classified'] += 1
+                    if not record['closed']:
+                        stats['opened'] += 1
+            # a batch is in the checkpoint once it is on disk. The pictures
+            # are moved after that: a move cut off by a crash is finished
+            # by load_checkpoint on the next run
+            out.flush()
+            os.fsync(out.fileno())
+            for record in records:
+                if 'moved_to' in record:
+                    _move(record)
+            elapsed = time() - start
+            logger.info("%d classified, %d failed, %.1f frames/s" %
+                        (stats['classified'], stats['failed'],
+                         stats['classified'] / elapsed if elapsed > 0 else 0.0))
+        completed = True
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, run again to resume")
+        raise
+    finally:
+        out.close()
+        # whatever stopped the loop, the workers are stopped with it
+        if pool is not None:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+    stats['seconds'] = time() - start
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='classify every picture under a directory')
+    parser.add_argument('dirname')
+    parser.add_argument('--day_model', required=True, help='model file or models directory')
+    parser.add_argument('--night_model', default=None, help='defaults to the day model')
+    parser.add_argument('--out', default=None,
+                        help='JSON lines output and checkpoint, defaults to <dirname>/predictions.jsonl')
+    parser.add_argument('--organize', action='store_true', help='move opened frames to <dirname>/open')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes, defaults to the number of cores')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--weight_mode', choices=sorted(predict_NN.ENGINE_LOADERS.keys()), default='float32')
+    parser.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX),
+                        help='roi the model was trained on: left upper right lower')
+    parser.add_argument('--roi_scale', type=int, default=1)
+    parser.add_argument('--decode', choices=ingest.DECODES, default='full',
+                           help='jpg decode the model was trained on')
+    parser.add_argument('--latitude', type=float, default=None)
+    parser.add_argument('--longitude', type=float, default=None)
+    args = parser.parse_args()
+
+    logging.setup(level='INFO')
+    if not os.path.isdir(args.dirname):
+        print "directory does not exist"
+        sys.exit(1)
+    # the models don't change during a run: no reloads, and the result
+    # cache and change gate only help a single stream of frames
+    predicter = predict_NN.Predicter_NN(args.day_model, args.night_model or args.day_model,
+                                        reload_interval=sys.maxint, batch_size=args.batch_size,
+                                        weight_mode=args.weight_mode,
+                                        spec=ingest.FrameSpec(args.roi, args.roi_scale, args.decode),
+                                        cache_size=0, change_threshold=0,
+                                        daylight_oracle=daylight.DaylightOracle(args.latitude, args.longitude))
+    out_file = args.out or os.path.join(args.dirname, 'predictions.jsonl')
+    try:
+        stats = classify_tree(predicter, args.dirname, out_file, args.workers, args.batch_size, args.organize)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    print "%d classified (%d opened), %d failed, %d already done, %.1f s" % \
+          (stats['classified'], stats['opened'], stats['failed'], stats['skipped'], stats['seconds'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import common.log as logging
+import threading
+import numpy
+import predict
+# registers the Predicter_Brightness options (the usual cheap first stage)
+# before the config is parsed, like prediction_manager does for predict_NN
+import predict_brightness
+
+from time import time
+from sys import _getframe
+
+logger = logging.getLogger()
+
+class Stage (object):
+    '''
+    Stage - one predicter of a cascade and its counters.
+
+    The stage decides the frame when its confidence is outside the
+    uncertainty band, i.e. <= low or >= high.
+    '''
+    def __init__(self, name, predicter, low=0.1, high=0.9):
+        if low > high:
+            raise ValueError("uncertainty band of %s is empty (%s > %s)" % (name, str(low), str(high)))
+        self.name = name
+        self.predicter = predicter
+        self.low = low
+        self.high = high
+        self.calls = 0
+        self.decided = 0
+        self.seconds = 0.0
+
+    def stats(self):
+        return {'name': self.name,
+                'calls': self.calls,
+                'decided': self.decided,
+                'hit_rate': float(self.decided) / self.calls if self.calls else 0.0,
+                'ms_per_call': self.seconds * 1000.0 / self.calls if self.calls else 0.0}
+
+class Cascade (predict.Predicter):
+    '''
+    Cascade - predicters run cheapest first.
+
+    Each stage answers the frame when it is confident enough; only the
+    frames it is unsure about go on to the next (more expensive) stage. The
+    last stage always answers. The per stage hit rates and latencies give
+    the average cost per frame:
+      sum over stages of (frames reaching the stage * ms_per_call)
+    '''
+    def __init__(self, stages):
+        super(Cascade, self).__init__()
+        if len(stages) == 0:
+            raise ValueError("a cascade needs at least one stage")
+        self.stages = stages
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.seconds = 0.0
+
+    def predictImage (self, filename):
+        start = time()
+        result = None
+        for index, stage in enumerate(self.stages):
+            stage_start = time()
+            prediction = stage.predicter.predict(filename)
+            closed = prediction[0]
+            confidence = float(numpy.ravel(prediction[1])[0])
+            elapsed = time() - stage_start
+
+            last = index == len(self.stages) - 1
+            decided = last or confidence <= stage.low or confidence >= stage.high
+            with self.lock:
+                stage.calls += 1
+                stage.seconds += elapsed
+                if decided:
+                    stage.decided += 1
+            if decided:
+                logger.debug(filename + "\t(" + str(confidence) + ") \t[" + stage.name + "]")
+                result = predict.Prediction(closed, confidence, getattr(prediction, 'version', None),
+                                            getattr(prediction, 'skipped', None))
+                break
+
+        with self.lock:
+            self.frames += 1
+            self.seconds += time() - start
+        return result
+
+    def predict(self, filename):
+        logger.debug(_getframe().f_code.co_name + ' called')
+        return self.predictImage(filename)
+
+    # per stage counters plus the average time per frame
+    def stats(self):
+        with self.lock:
+            return {'frames': self.frames,
+                    'ms_per_frame': self.seconds * 1000.0 / self.frames if self.frames else 0.0,
+                    'stages': [stage.stats() for stage in self.stages]}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info("cascade: %d frames, %.2f ms/frame" % (stats['frames'], stats['ms_per_frame']))
+        for stage in stats['stages']:
+            logger.info("  %-24s %6d calls %6d decided (%.1f%%) %8.2f ms/call" %
+                        (stage['name'], stage['calls'], stage['decided'],
+                         stage['hit_rate'] * 100.0, stage['ms_per_call']))
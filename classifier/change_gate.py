@@ -0,0 +1,88 @@
+import common.log as logging
+import threading
+import numpy
+
+import ingest
+
+logger = logging.getLogger()
+
+class ChangeGate (object):
+    '''
+    ChangeGate - skips the network while the scene stays the same.
+
+    Every frame is reduced to a small thumbnail of the roi (see
+    ingest.load_thumbnail). The thumbnail is compared with the one of the
+    last frame that was actually classified; if the mean absolute
+    difference is below threshold (in 0-255 grey levels) and the frame would
+    be classified by the same model, the last result is reused. The compare
+    is always against the last classified frame, so a slow drift still
+    triggers a new classification once it adds up. After max_skip reuses in
+    a row the frame is classified anyway (0 means no limit).
+
+    Only useful on a stream of consecutive frames of one camera: files that
+    are not in capture order would get the result of an unrelated picture.
+    '''
+    def __init__(self, threshold=2.0, max_skip=30, spec=ingest.DEFAULT_SPEC):
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.spec = spec
+        self.lock = threading.Lock()
+        self.reference = None
+        self.model = None
+        self.result = None
+        self.source = None
+        self.run = 0
+        self.evaluated = 0
+        self.skipped = 0
+
+    # thumbnail of filename or None if it cannot be decoded
+    def signature(self, filename):
+        try:
+            return ingest.load_thumbnail(filename, self.spec)
+        except IOError as ex:
+            logger.debug(ex)
+            return None
+
+    # mean absolute difference of two thumbnails
+    @staticmethod
+    def difference(a, b):
+        return float(numpy.mean(numpy.abs(a - b)))
+
+    # (last result, file it was classified from) if the scene did not
+    # change, else None. model identifies the model the frame would be
+    # classified with
+    def lookup(self, signature, model):
+        with self.lock:
+            if signature is None or self.reference is None or self.model != model or \
+               (self.max_skip > 0 and self.run >= self.max_skip):
+                return None
+            if self.difference(signature, self.reference) >= self.threshold:
+                return None
+            self.run += 1
+            self.skipped += 1
+            return (self.result, self.source)
+
+    # record the result of filename, a frame that went through the network
+    def update(self, signature, model, result, filename=None):
+        with self.lock:
+            self.evaluated += 1
+            self.run = 0
+            self.reference = signature
+            self.model = model
+            self.result = result
+            self.source = filename
+
+    def reset(self):
+        with self.lock:
+            self.reference = None
+            self.result = None
+            self.source = None
+            self.run = 0
+
+    # counters for monitoring
+    def stats(self):
+        with self.lock:
+            total = self.evaluated + self.skipped
+            return {'evaluated': self.evaluated,
+                    'skipped': self.skipped,
+                    'skip_rate': float(self.skipped) / total if total else 0.0}
@@ -0,0 +1,179 @@
+#!/bin/python
+"""
+Training set loading.
+
+load_dataset() decodes a list of jpgs into one preallocated matrix, one
+row per picture in the column major order Train_NN was trained with. The
+rows are filled in place, so loading is linear in the number of pictures
+and the peak memory is the matrix plus one frame.
+
+ChunkedDataset keeps the same matrix in a uint8 (or float32) file instead
+and hands it out a chunk of rows at a time, for training sets that don't
+fit in memory.
+
+  python -m classifier.dataset [directory] --repeat 40
+
+compares its throughput and memory high-water mark with the per picture
+numpy.concatenate the trainer used before.
+"""
+import common.log as logging
+import argparse
+import multiprocessing
+import os
+import resource
+from re import search
+from time import time
+import numpy
+
+import ingest
+
+logger = logging.getLogger()
+
+# memory high-water mark of this process in MB (ru_maxrss is in KB on Linux)
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# decode files into a len(files) x spec.size matrix of dtype (or into out).
+# row i is files[i] flattened in column major order. With cache (a
+# feature_cache.FeatureCache of spec) only pictures not decoded before are
+# decoded. Raises IOError if a picture cannot be decoded
+def load_dataset(files, spec=ingest.DEFAULT_SPEC, dtype=numpy.float64, out=None, cache=None, report=True):
+    if out is None:
+        out = numpy.empty((len(files), spec.size), dtype=dtype)
+    elif out.shape != (len(files), spec.size):
+        raise ValueError("dataset buffer is %s, %d pictures of %s need %s" %
+                         (str(out.shape), len(files), str(spec), str((len(files), spec.size))))
+    start = time()
+    if cache is not None:
+        frames = cache.frames(files)
+        for row in range(len(files)):
+            out[row] = frames[row].ravel(order='F')
+    else:
+        frame = numpy.empty(spec.shape, dtype=numpy.uint8)
+        for row, filename in enumerate(files):
+            try:
+                ingest.load_frame(filename, frame, spec)
+            except IOError:
+                logger.error("Load image failed: " + filename)
+                raise
+            out[row] = frame.ravel(order='F')
+    elapsed = time() - start
+    if not report:
+        return out
+    logger.info("Loaded %d pictures in %.2f s (%.1f pictures/s, %.1f MB/s), max RSS %.0f MB" %
+                (len(files), elapsed, len(files) / elapsed if elapsed > 0 else 0.0,
+                 out.nbytes / 1048576.0 / elapsed if elapsed > 0 else 0.0, max_rss_mb()))
+    return out
+
+class ChunkedDataset (object):
+    '''
+    ChunkedDataset - training matrix kept in a file, read a chunk at a time.
+
+    filename holds rows x cols values of dtype (uint8 pixels or float32
+    features), row major, in the row layout of load_dataset. chunks() maps
+    chunk_size rows at a time and unmaps them again before the next chunk,
+    so the memory used is one chunk (plus its float64 copy) whatever the
+    number of rows.
+    '''
+    def __init__(self, filename, rows, cols, dtype=numpy.uint8, chunk_size=256):
+        self.filename = filename
+        self.dtype = numpy.dtype(dtype)
+        self.shape = (rows, cols)
+        self.chunk_size = chunk_size
+
+    # decode files into filename a chunk at a time (see load_dataset)
+    @classmethod
+    def build(cls, files, filename, spec=ingest.DEFAULT_SPEC, dtype=numpy.uint8, chunk_size=256, cache=None):
+        data = cls(filename, len(files), spec.size, dtype, chunk_size)
+        with open(filename, 'wb') as f:
+            f.truncate(data.nbytes)
+        start = time()
+        for first, rows in data._ranges():
+            part = data._map(first, rows, 'r+')
+            load_dataset(files[first:first+rows], spec, dtype, part, cache, report=False)
+            part.flush()
+            del part
+        elapsed = time() - start
+        logger.info("Wrote %d pictures to %s in %.2f s (%.1f pictures/s), max RSS %.0f MB" %
+                    (len(files), filename, elapsed, len(files) / elapsed if elapsed > 0 else 0.0, max_rss_mb()))
+        return data
+
+    @property
+    def nbytes(self):
+        return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def _ranges(self):
+        for first in range(0, self.shape[0], self.chunk_size):
+            yield first, min(self.chunk_size, self.shape[0] - first)
+
+    def _map(self, first, rows, mode='r'):
+        return numpy.memmap(self.filename, dtype=self.dtype, mode=mode,
+                            offset=first * self.shape[1] * self.dtype.itemsize,
+                            shape=(rows, self.shape[1]))
+
+    # (first row, numpy.matrix of the chunk in dtype) for every chunk
+    def chunks(self, dtype=numpy.float64):
+        for first, rows in self._ranges():
+            part = self._map(first, rows)
+            chunk = numpy.asmatrix(numpy.array(part, dtype=dtype))
+            del part
+            yield first, chunk
+
+    # numpy.matrix of the given rows (sorted indexes) in dtype
+    def rows(self, indexes, dtype=numpy.float64):
+        whole = self._map(0, self.shape[0])
+        rows = numpy.asmatrix(numpy.array(whole[indexes], dtype=dtype))
+        del whole
+        return rows
+
+# what Train_NN.train did before load_dataset. kept for benchmark()
+def _load_concatenate(files, spec=ingest.DEFAULT_SPEC):
+    imageMatrix = None
+    for filename in files:
+        imageX = numpy.matrix(ingest.load_frame(filename, spec=spec), dtype=numpy.float64)
+        imageX = imageX.flatten('F')
+        if imageMatrix is None:
+            imageMatrix = numpy.matrix(imageX, dtype=numpy.float64)
+        else:
+            imageMatrix = numpy.concatenate((imageMatrix, imageX))
+    return imageMatrix
+
+LOADERS = {'preallocated': load_dataset, 'concatenate': _load_concatenate}
+
+# runs in a fresh worker process, so the high-water mark is the loader's own
+def _measure(name, files, spec):
+    base = max_rss_mb()
+    start = time()
+    X = LOADERS[name](files, spec)
+    return (time() - start, max_rss_mb() - base, X.nbytes / 1048576.0)
+
+def benchmark(dirname, repeat=1, spec=ingest.DEFAULT_SPEC):
+    files = [os.path.join(dirname, f) for f in sorted(os.listdir(dirname))
+             if search(r"(.+)\.jpg", f) is not None] * repeat
+    if len(files) == 0:
+        print "no jpg files in " + dirname
+        return
+    print "%-14s %8s %10s %14s %14s" % ('loader', 'frames', 'seconds', 'frames/sec', 'peak MB (data)')
+    for name in ('preallocated', 'concatenate'):
+        pool = multiprocessing.Pool(1)
+        try:
+            seconds, peak, size = pool.apply(_measure, (name, files, spec))
+        finally:
+            pool.close()
+            pool.join()
+        print "%-14s %8d %10.2f %14.1f %8.0f (%.0f)" % (name, len(files), seconds, len(files) / seconds, peak, size)
+
+def main():
+    parser = argparse.ArgumentParser(description='throughput and peak memory of the training set loader')
+    parser.add_argument('dirname', help='directory of jpgs')
+    parser.add_argument('--repeat', type=int, default=1, help='load every picture this many times')
+    parser.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX))
+    parser.add_argument('--roi_scale', type=int, default=1)
+    parser.add_argument('--decode', choices=ingest.DECODES, default='full',
+                           help='jpg decode (see ingest.py)')
+    args = parser.parse_args()
+    logging.setup(level='WARNING')
+    benchmark(args.dirname, args.repeat, ingest.FrameSpec(args.roi, args.roi_scale, args.decode))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import common.log as logging
+import os
+import threading
+import calendar
+from time import localtime
+from datetime import date, datetime, timedelta
+from math import sin, cos, tan, asin, acos, atan, radians, degrees, floor
+from re import match
+import numpy
+
+logger = logging.getLogger()
+
+# zenith of the sun at sunrise/sunset: 90 degrees plus refraction and the
+# radius of the sun
+ZENITH = 90.833
+MINUTES_PER_DAY = 24 * 60
+# window used when no latitude/longitude is configured (minutes of the day)
+DEFAULT_SUNRISE = 6 * 60
+DEFAULT_SUNSET = 18 * 60
+
+# time in a yyyymmdd_hhmm_ss.jpg filename as a datetime, None if the name
+# does not follow that format
+def timestamp_from_filename(filename):
+    matobj = match(r"(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})_(\d{2})\.jpg", os.path.basename(filename))
+    if matobj is None:
+        return None
+    try:
+        return datetime(*[int(x) for x in matobj.groups()])
+    except ValueError:
+        return None
+
+# UTC hour of sunrise (rising=True) or sunset on day of the year yday.
+# None if the sun stays above the horizon all day, False if it stays below.
+# The sunrise equation from the Almanac for Computers (1990), accurate to
+# a couple of minutes
+def sun_event_utc(yday, latitude, longitude, rising, zenith=ZENITH):
+    lng_hour = longitude / 15.0
+    t = yday + ((6.0 if rising else 18.0) - lng_hour) / 24.0
+    # mean anomaly and true longitude of the sun
+    M = 0.9856 * t - 3.289
+    L = (M + 1.916 * sin(radians(M)) + 0.020 * sin(radians(2 * M)) + 282.634) % 360.0
+    # right ascension, in the same quadrant as L, in hours
+    RA = degrees(atan(0.91764 * tan(radians(L)))) % 360.0
+    RA = (RA + floor(L / 90.0) * 90.0 - floor(RA / 90.0) * 90.0) / 15.0
+    # declination and local hour angle
+    sin_dec = 0.39782 * sin(radians(L))
+    cos_dec = cos(asin(sin_dec))
+    cos_H = (cos(radians(zenith)) - sin_dec * sin(radians(latitude))) / (cos_dec * cos(radians(latitude)))
+    if cos_H > 1:
+        return False
+    if cos_H < -1:
+        return None
+    H = (360.0 - degrees(acos(cos_H)) if rising else degrees(acos(cos_H))) / 15.0
+    T = H + RA - 0.06571 * t - 6.622
+    return (T - lng_hour) % 24.0
+
+# minute of the local day of an event at utc_hour around day. The UTC date
+# of a local sunset can be the next day, so the candidate on the right
+# local date is picked
+def _local_minutes(day, utc_hour):
+    midnight = calendar.timegm(day.timetuple())
+    for shift in (0, -1, 1):
+        t = localtime(midnight + utc_hour * 3600.0 + shift * 86400)
+        if date(t.tm_year, t.tm_mon, t.tm_mday) == day:
+            return t.tm_hour * 60 + t.tm_min
+    return None
+
+class DaylightOracle (object):
+    '''
+    DaylightOracle - tells whether a timestamp is during the day.
+
+    Sunrise and sunset are computed from latitude/longitude (degrees, north
+    and east positive) and converted to the local time zone of the machine,
+    DST included. The window is widened by sunrise_offset/sunset_offset
+    minutes (the day model also copes with twilight). The times of a whole
+    year are computed the first time a date of that year is asked for and
+    kept as a days x 2 table of minutes, so every later answer is one table
+    lookup. Without a latitude/longitude the fixed sunrise..sunset window
+    is used.
+    '''
+    def __init__(self, latitude=None, longitude=None, sunrise_offset=-20, sunset_offset=30,
+                 sunrise=DEFAULT_SUNRISE, sunset=DEFAULT_SUNSET):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.sunrise_offset = sunrise_offset
+        self.sunset_offset = sunset_offset
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.tables = dict()
+        self.lock = threading.Lock()
+        if (latitude is None) != (longitude is None):
+            raise ValueError("latitude and longitude have to be given together")
+
+    # (sunrise, sunset) in minutes of the local day, offsets applied
+    def _day_window(self, day):
+        if self.latitude is None:
+            return (self.sunrise, self.sunset)
+        yday = day.timetuple().tm_yday
+        rise = sun_event_utc(yday, self.latitude, self.longitude, True)
+        set_ = sun_event_utc(yday, self.latitude, self.longitude, False)
+        if rise is None or set_ is None:
+            return (0, MINUTES_PER_DAY)     # midnight sun
+        if rise is False or set_ is False:
+            return (0, 0)                   # polar night
+        rise = _local_minutes(day, rise)
+        set_ = _local_minutes(day, set_)
+        if rise is None or set_ is None:
+            return (self.sunrise, self.sunset)
+        return (max(0, rise + self.sunrise_offset),
+                min(MINUTES_PER_DAY, set_ + self.sunset_offset))
+
+    # days x 2 int16 table of the (sunrise, sunset) minutes of year
+    def table(self, year):
+        table = self.tables.get(year)
+        if table is not None:
+            return table
+        first = date(year, 1, 1)
+        days = (date(year + 1, 1, 1) - first).days
+        table = numpy.empty((days, 2), dtype=numpy.int16)
+        for index in range(days):
+            table[index] = self._day_window(first + timedelta(days=index))
+        with self.lock:
+            self.tables[year] = table
+        logger.debug("Computed sunrise/sunset table for %d" % year)
+        return table
+
+    # (sunrise, sunset) minutes of the local day of when
+    def window(self, when):
+        return tuple(self.table(when.year)[when.timetuple().tm_yday - 1])
+
+    # True if the datetime when falls between sunrise and sunset
+    def is_daytime(self, when):
+        rise, set_ = self.table(when.year)[when.timetuple().tm_yday - 1]
+        minute = when.hour * 60 + when.minute
+        return rise <= minute < set_
+
+    # is_daytime of the time in a yyyymmdd_hhmm_ss.jpg filename, or of the
+    # current local time if the filename has none
+    def is_daytime_file(self, filename):
+        when = timestamp_from_filename(filename)
+        if when is None:
+            when = datetime(*localtime()[:6])
+        return self.is_daytime(when)
@@ -0,0 +1,57 @@
+import common.log as logging
+import os
+from re import search
+from time import time
+
+logger = logging.getLogger()
+
+# list the jpgs of a labeled directory laid out like TrainingSet/day:
+#   <dirname>/closed/*.jpg are labeled 1
+#   <dirname>/opened/*.jpg are labeled 0
+# returns (files, labels)
+def labeled_files(dirname):
+    files = list()
+    labels = list()
+    for label, subdir in ((1, 'closed'), (0, 'opened')):
+        subpath = os.path.join(dirname, subdir)
+        if not os.path.isdir(subpath):
+            logger.warning("Missing labeled directory " + subpath)
+            continue
+        for file in sorted(os.listdir(subpath)):
+            if search(r"(.+)\.jpg", file) is not None:
+                files.append(os.path.join(subpath, file))
+                labels.append(label)
+    return (files, labels)
+
+# run predicter.predict_batch over the labeled files.
+# returns a dict with the accuracy, the time per frame and the confidence
+# of every file (None if it could not be classified).
+# With cache (a feature_cache.FeatureCache of the predicter's frame spec)
+# the frames come from the cache; predicters that classify whole frame
+# arrays (predict_array_batch) then don't decode any picture seen before
+def evaluate(predicter, files, labels, cache=None):
+    start = time()
+    if cache is not None and hasattr(predicter, 'predict_array_batch'):
+        frames = cache.frames(files)
+        results = predicter.predict_array_batch(frames, [predicter.isDayTime(f) for f in files])
+    else:
+        results = predicter.predict_batch(files)
+    elapsed = time() - start
+
+    correct = 0
+    classified = 0
+    confidences = list()
+    for result, label in zip(results, labels):
+        if result is None:
+            confidences.append(None)
+            continue
+        closed, confidence = result[0], result[1]
+        classified = classified + 1
+        if int(closed) == label:
+            correct = correct + 1
+        confidences.append(confidence)
+
+    return {'frames': classified,
+            'accuracy': float(correct) / classified if classified else 0.0,
+            'seconds_per_frame': elapsed / len(files) if len(files) else 0.0,
+            'confidences': confidences}
@@ -0,0 +1,82 @@
+import common.log as logging
+import multiprocessing
+from eventlet import greenpool
+from eventlet import tpool
+
+logger = logging.getLogger()
+
+POOLS = ('thread', 'process')
+
+# function run by the process pool workers. Set before the pool forks, so
+# every worker inherits the predicters (and their memory mapped models)
+# instead of building its own
+_worker_function = None
+
+def _worker_call(filename):
+    return _worker_function(filename)
+
+class ClassificationExecutor (object):
+    '''
+    ClassificationExecutor - runs predict calls off the eventlet hub.
+
+    The NumPy/PIL work of a prediction doesn't yield to the hub, so run on
+    a green thread it stalls every timer and signal handler until the frame
+    is classified. submit() hands the call to an OS thread (eventlet tpool,
+    pool='thread') or to a forked worker process (pool='process') and
+    returns an eventlet GreenThread right away: wait() on it for the result
+    or link() a callback. At most size calls run at the same time; more
+    submits wait (green) for a free slot.
+
+    function is called with the filename, e.g. PredictionManager.predict.
+    '''
+    def __init__(self, function, size=2, pool='thread'):
+        global _worker_function
+        if pool not in POOLS:
+            raise ValueError("Unknown classifier pool " + str(pool))
+        self.function = function
+        self.size = size
+        self.pool = pool
+        self.green = greenpool.GreenPool(size)
+        self.processes = None
+        if pool == 'process':
+            _worker_function = function
+            self.processes = multiprocessing.Pool(size)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _run(self, filename):
+        try:
+            if self.processes is not None:
+                # the worker's answer is waited for on an OS thread too
+                result = tpool.execute(self.processes.apply, _worker_call, (filename,))
+            else:
+                result = tpool.execute(self.function, filename)
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        return result
+
+    # classify filename off the hub. returns a GreenThread
+    def submit(self, filename):
+        self.submitted += 1
+        return self.green.spawn(self._run, filename)
+
+    # classify filename and wait (green) for the result
+    def predict(self, filename):
+        return self.submit(filename).wait()
+
+    def stats(self):
+        return {'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'running': self.green.running()}
+
+    # wait for the submitted calls and stop the workers
+    def shutdown(self):
+        self.green.waitall()
+        if self.processes is not None:
+            self.processes.close()
+            self.processes.join()
+            self.processes = None
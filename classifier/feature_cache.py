@@ -0,0 +1,159 @@
+import common.log as logging
+import cPickle as pickle
+import fcntl
+import os
+import numpy
+
+import ingest
+
+logger = logging.getLogger()
+
+# bumped when the layout of the store or the decode of ingest.load_frame
+# changes, so frames made the old way are never reused
+FORMAT_VERSION = 2
+
+# name of the store of one frame spec. Another roi, scale or decode gets
+# another store, so changing them never serves frames made the old way
+def spec_key(spec):
+    return "v%d_roi%d_%d_%d_%d_s%d_%s" % ((FORMAT_VERSION,) + spec.roi + (spec.scale, spec.decode))
+
+class FeatureCache (object):
+    '''
+    FeatureCache - decoded frames of pictures kept on disk.
+
+    Every picture is decoded once with ingest.load_frame and its uint8 frame
+    appended to frames.u8 in the store of the frame spec (see spec_key).
+    index.pkl maps the absolute path of the picture to the (mtime, size) it
+    had and its row in frames.u8; a picture whose mtime or size changed is
+    decoded again to a new row. frames() hands back the rows as views of a
+    read only memory map, so a training set much larger than memory loads
+    at disk speed without decoding anything.
+
+    The rows of pictures decoded again (or gone) stay in frames.u8 until
+    they are more than half of it, then the store is rewritten.
+    '''
+    def __init__(self, dirname, spec=ingest.DEFAULT_SPEC):
+        self.spec = spec
+        self.root = os.path.join(dirname, spec_key(spec))
+        self.frames_file = os.path.join(self.root, 'frames.u8')
+        self.index_file = os.path.join(self.root, 'index.pkl')
+        self.lock_file = os.path.join(self.root, 'lock')
+        self.frame_size = spec.shape[0] * spec.shape[1]
+        self.index = dict()
+        self.rows = 0
+        self.hits = 0
+        self.decoded = 0
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.load()
+
+    def load(self):
+        self.index = dict()
+        self.rows = 0
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'rb') as f:
+                version, rows, index = pickle.load(f)
+        except Exception as ex:
+            logger.warning("Feature cache index unreadable, starting over: " + self.index_file)
+            logger.debug(ex)
+            return
+        # the frames are written before the index, so a shorter frames file
+        # means the store was damaged
+        if version != FORMAT_VERSION or not os.path.exists(self.frames_file) or \
+           os.path.getsize(self.frames_file) < rows * self.frame_size:
+            logger.warning("Feature cache does not match its index, starting over: " + self.root)
+            return
+        self.index = index
+        self.rows = rows
+
+    def _save_index(self):
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((FORMAT_VERSION, self.rows, self.index), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.index_file)
+
+    # (mtime, size) of filename
+    def _stamp(self, filename):
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size)
+
+    # decode the pictures not in the store (or changed since) and append
+    # them. Raises IOError if a picture cannot be decoded
+    def update(self, files):
+        with open(self.lock_file, 'w') as lock:
+            # one writer at a time, e.g. two trainers sharing the store
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.load()
+            stale = list()
+            seen = set()
+            for filename in files:
+                path = os.path.abspath(filename)
+                if path in seen:
+                    continue
+                seen.add(path)
+                stamp = self._stamp(path)
+                entry = self.index.get(path)
+                if entry is None or entry[:2] != stamp:
+                    stale.append((path, stamp))
+            if len(stale) == 0:
+                return 0
+
+            frame = numpy.empty(self.spec.shape, dtype=numpy.uint8)
+            with open(self.frames_file, 'r+b' if os.path.exists(self.frames_file) else 'wb') as f:
+                # drop anything past the last indexed row (an interrupted append)
+                f.truncate(self.rows * self.frame_size)
+                f.seek(self.rows * self.frame_size)
+                for path, stamp in stale:
+                    try:
+                        ingest.load_frame(path, frame, self.spec)
+                    except IOError:
+                        logger.error("Load image failed: " + path)
+                        raise
+                    f.write(frame.tostring())
+                    self.index[path] = stamp + (self.rows,)
+                    self.rows += 1
+                f.flush()
+                os.fsync(f.fileno())
+            self._save_index()
+            self.decoded += len(stale)
+            if self.rows > 2 * len(self.index):
+                self._compact()
+            return len(stale)
+
+    # rewrite the store with the live rows only. Called with the lock held
+    def _compact(self):
+        frames = numpy.memmap(self.frames_file, dtype=numpy.uint8, mode='r',
+                              shape=(self.rows, self.frame_size))
+        tmp = self.frames_file + '.tmp'
+        index = dict()
+        with open(tmp, 'wb') as f:
+            for row, (path, entry) in enumerate(sorted(self.index.items(), key=lambda x: x[1][2])):
+                f.write(frames[entry[2]].tostring())
+                index[path] = entry[:2] + (row,)
+            f.flush()
+            os.fsync(f.fileno())
+        del frames
+        logger.debug("Feature cache compacted from %d to %d rows" % (self.rows, len(index)))
+        os.rename(tmp, self.frames_file)
+        self.index = index
+        self.rows = len(index)
+        self._save_index()
+
+    # uint8 frames (spec.shape) of files, in order, as read only views of
+    # the store. Only new or changed pictures are decoded
+    def frames(self, files):
+        decoded = self.update(files)
+        self.hits += len(files) - decoded
+        if self.rows == 0:
+            return []
+        store = numpy.memmap(self.frames_file, dtype=numpy.uint8, mode='r',
+                             shape=(self.rows,) + self.spec.shape)
+        return [store[self.index[os.path.abspath(filename)][2]] for filename in files]
+
+    def stats(self):
+        return {'rows': self.rows,
+                'pictures': len(self.index),
+                'hits': self.hits,
+                'decoded': self.decoded}
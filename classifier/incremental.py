@@ -0,0 +1,155 @@
+import common.log as logging
+import cPickle as pickle
+import os
+from time import strftime
+import numpy
+
+import ingest
+import model_file
+import nn_engine
+import weight_cache
+
+logger = logging.getLogger()
+
+# bumped when the layout of the ledger changes
+FORMAT_VERSION = 2
+
+# (Theta1, Theta2) of the model a location (file or models directory, see
+# weight_cache.resolve) stands for, Theta1 on the pixels of spec. None if
+# there is no model there yet
+def load_warm_start(location, spec=ingest.DEFAULT_SPEC):
+    filename = weight_cache.resolve(location)
+    if filename is None or not os.path.exists(filename):
+        return None
+    if model_file.is_model_file(filename):
+        header, arrays = model_file.load_checked(filename, spec)
+        if header['kind'] != 'float32':
+            raise ValueError("%s is a %s model, warm start needs a float32 one" % (filename, header['kind']))
+        Theta1, Theta2 = nn_engine.NNEngine.from_arrays(arrays, spec.shape).to_thetas()
+    else:
+        # a projection saved with the Thetas is folded into Theta1
+        Theta1, Theta2 = weight_cache.load_thetas(filename)
+        Theta1 = numpy.array(Theta1, dtype=numpy.float64)
+        Theta2 = numpy.array(Theta2, dtype=numpy.float64)
+        if Theta1.shape[1] != spec.size + 1:
+            raise ValueError("%s takes %d inputs, %s has %d" %
+                             (filename, Theta1.shape[1] - 1, repr(spec), spec.size))
+    logger.info("Warm start from " + filename)
+    return (Theta1, Theta2)
+
+class SeenLedger (object):
+    '''
+    SeenLedger - the training pictures a model has already been trained on.
+
+    The ledger file maps the absolute path of every picture to the (mtime,
+    size) and label it was trained with and the increment it was last
+    trained in. A picture is new until it is recorded, and again once its
+    file or its label changes. increments keeps what every increment did.
+    model is the weight_cache.file_stamp (path, mtime, size) of the model
+    the recorded pictures were trained into: a ledger is only good for
+    fine-tuning that same model (see matches).
+
+    The file is written to a temporary name and renamed into place, so an
+    interrupted increment leaves the ledger of the one before.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = dict()
+        self.increments = list()
+        self.model = None
+        self.load()
+
+    # forget every picture, e.g. when the model to fine-tune isn't the one
+    # the ledger was written for
+    def reset(self):
+        self.entries = dict()
+        self.increments = list()
+        self.model = None
+
+    def load(self):
+        self.reset()
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+            version = data[0]
+        except Exception as ex:
+            logger.warning("Seen ledger unreadable, every picture is new: " + self.filename)
+            logger.debug(ex)
+            return
+        if version != FORMAT_VERSION:
+            logger.warning("Seen ledger has version %d, every picture is new: %s" % (version, self.filename))
+            return
+        self.entries, self.increments, self.model = data[1:]
+
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((FORMAT_VERSION, self.entries, self.increments, self.model), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.filename)
+
+    # (mtime, size, label) a picture is recorded with
+    def _key(self, filename, label):
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size, label)
+
+    # True if filename with label was trained on as it is now
+    def seen(self, filename, label):
+        entry = self.entries.get(os.path.abspath(filename))
+        return entry is not None and entry[:3] == self._key(filename, label)
+
+    # True if the ledger was written for the model of stamp (see
+    # weight_cache.file_stamp). An empty ledger matches any model
+    def matches(self, stamp):
+        if self.model is None:
+            return len(self.entries) == 0
+        return stamp is not None and \
+               (os.path.abspath(stamp[0]),) + tuple(stamp[1:]) == self.model
+
+    # record that model was trained on files (with labels). Pictures not in
+    # current (every labeled picture there is) are forgotten. stamp is the
+    # file_stamp of the saved model
+    def record(self, files, labels, current, model=None, replayed=0, stamp=None):
+        increment = len(self.increments) + 1
+        for filename, label in zip(files, labels):
+            self.entries[os.path.abspath(filename)] = self._key(filename, label) + (increment,)
+        keep = set(os.path.abspath(filename) for filename in current)
+        for path in [path for path in self.entries if path not in keep]:
+            del self.entries[path]
+        self.increments.append({'time': strftime('%Y-%m-%d %H:%M:%S'),
+                                'model': model,
+                                'trained': len(files),
+                                'new': len(files) - replayed,
+                                'replayed': replayed})
+        if stamp is not None:
+            self.model = (os.path.abspath(stamp[0]),) + tuple(stamp[1:])
+        self.save()
+
+    def stats(self):
+        return {'pictures': len(self.entries),
+                'increments': len(self.increments)}
+
+# indexes (new, replay) into files of an increment: every picture the
+# ledger hasn't seen as it is now, and replay_ratio times as many of the
+# seen ones to keep the model from forgetting them. The pictures replayed
+# longest ago go first (ties in random order), so the history is replayed
+# in turn rather than the same sample every time
+def select(files, labels, ledger, replay_ratio=4.0, seed=None):
+    new = list()
+    seen = list()
+    for i, (filename, label) in enumerate(zip(files, labels)):
+        if ledger.seen(filename, label):
+            seen.append(i)
+        else:
+            new.append(i)
+    count = min(len(seen), int(round(replay_ratio * len(new))))
+    rng = numpy.random.RandomState(seed)
+    ties = rng.random_sample(len(seen))
+    order = sorted(range(len(seen)),
+                   key=lambda j: (ledger.entries[os.path.abspath(files[seen[j]])][3], ties[j]))
+    replay = sorted(seen[j] for j in order[:count])
+    return (new, replay)
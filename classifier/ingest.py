@@ -0,0 +1,214 @@
+#!/bin/python
+"""
+Shared JPEG ingest for the classifier and the trainer.
+
+The camera takes 640x480 pictures. The network looks at the picture scaled
+to 320x240 with the bottom 20 rows cropped off (320x220 greyscale), or at
+the region of interest set by the roi/roi_scale options (see FrameSpec).
+
+The full decode (the default) decodes the colour picture, converts and
+resizes it exactly as the models were always trained. The draft decode puts
+the JPEG decoder in draft mode so it decodes the luma plane straight at the
+reduced scale, and the crop happens before any resampling. It is several
+times faster but its pixels differ from the full decode, so a model has to
+be trained on the decode it is used with; the decode is part of FrameSpec
+and of the native model header.
+
+  python -m classifier.ingest [directory]
+
+runs a frames/sec benchmark of the two decodes on a directory of jpgs
+(defaults to the FakeCam picture directory) and prints how far their
+pixels are apart.
+"""
+import common.log as logging
+import common.config as Conf
+import argparse
+import os
+from re import search
+from time import time
+import numpy
+import Image
+
+logger = logging.getLogger()
+CONF = Conf.Config
+
+# size (w, h) the camera picture is normalized to
+FRAME_SIZE = (320, 240)
+# part of the normalized picture fed to the network (left, upper, right, lower)
+CROP_BOX = (0, 0, 320, 220)
+# how a picture is decoded into a frame (see load_frame)
+DECODES = ('full', 'draft')
+
+class FrameSpec (object):
+    '''
+    FrameSpec - the part of the picture fed to the network.
+
+    roi is a (left, upper, right, lower) box in the coordinates of the
+    picture normalized to 320x240, scale an integer downscale factor applied
+    to that box. shape is the rows x cols of the resulting frame and size
+    the number of inputs of the network. decode is the JPEG decode, one of
+    DECODES.
+    '''
+    def __init__(self, roi=CROP_BOX, scale=1, decode='full'):
+        roi = tuple(int(x) for x in roi)
+        scale = int(scale)
+        if len(roi) != 4:
+            raise ValueError("roi needs 4 values (left upper right lower), got " + str(roi))
+        if roi[0] < 0 or roi[1] < 0 or roi[2] > FRAME_SIZE[0] or roi[3] > FRAME_SIZE[1] or \
+           roi[0] >= roi[2] or roi[1] >= roi[3]:
+            raise ValueError("roi %s is not a box inside %dx%d" % (str(roi), FRAME_SIZE[0], FRAME_SIZE[1]))
+        if scale < 1 or (roi[2]-roi[0]) < scale or (roi[3]-roi[1]) < scale:
+            raise ValueError("invalid roi scale " + str(scale))
+        if decode not in DECODES:
+            raise ValueError("Unknown decode " + str(decode))
+        self.roi = roi
+        self.scale = scale
+        self.decode = decode
+        self.shape = ((roi[3]-roi[1]) // scale, (roi[2]-roi[0]) // scale)
+        self.size = self.shape[0] * self.shape[1]
+
+    # build from the roi/roi_scale/decode config options. An empty roi is
+    # the full crop
+    @classmethod
+    def from_conf(cls, roi=None, scale=None, decode=None):
+        return cls(roi or CROP_BOX, scale or 1, decode or 'full')
+
+    def __eq__(self, other):
+        return isinstance(other, FrameSpec) and self.roi == other.roi and self.scale == other.scale and \
+               self.decode == other.decode
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "FrameSpec(roi=%s, scale=%d, decode=%s)" % (str(self.roi), self.scale, self.decode)
+
+DEFAULT_SPEC = FrameSpec()
+# rows x cols of the default frame handed to the network
+FRAME_SHAPE = DEFAULT_SPEC.shape
+
+# size (w, h) of the thumbnail used to tell whether the scene changed
+THUMBNAIL_SIZE = (32, 22)
+
+# crop the roi out of im, whatever size the decoder produced
+def _crop_roi(im, roi):
+    scale_x = im.size[0] / float(FRAME_SIZE[0])
+    scale_y = im.size[1] / float(FRAME_SIZE[1])
+    box = (int(round(roi[0]*scale_x)), int(round(roi[1]*scale_y)),
+           int(round(roi[2]*scale_x)), int(round(roi[3]*scale_y)))
+    return im.crop(box)
+
+# decode filename into a uint8 frame of spec.shape (220x320 by default).
+# out is an optional caller provided uint8 buffer of that shape
+def load_frame(filename, out=None, spec=DEFAULT_SPEC):
+    im = Image.open(filename)
+    if spec.decode == 'draft':
+        # a 640x480 jpg is decoded at 1/2 scale (or less when the roi is
+        # downscaled) directly to greyscale
+        im.draft('L', (FRAME_SIZE[0] // spec.scale, FRAME_SIZE[1] // spec.scale))
+    else:
+        # what the models were trained on: full decode, convert, resize
+        im = im.convert('L').resize(FRAME_SIZE)
+
+    im = _crop_roi(im, spec.roi)
+    if im.mode != 'L':
+        im = im.convert('L')
+    if im.size != (spec.shape[1], spec.shape[0]):
+        im = im.resize((spec.shape[1], spec.shape[0]))
+
+    if out is None:
+        out = numpy.empty(spec.shape, dtype=numpy.uint8)
+    out[...] = numpy.asarray(im)
+    return out
+
+# small float32 greyscale thumbnail of the roi. The jpg is decoded at 1/8
+# scale, which is a fraction of the cost of load_frame
+def load_thumbnail(filename, spec=DEFAULT_SPEC, size=THUMBNAIL_SIZE):
+    im = Image.open(filename)
+    im.draft('L', (FRAME_SIZE[0] // 4, FRAME_SIZE[1] // 4))
+    im = _crop_roi(im, spec.roi)
+    if im.mode != 'L':
+        im = im.convert('L')
+    im = im.resize(size, Image.ANTIALIAS)
+    return numpy.asarray(im, dtype=numpy.float32)
+
+# 256 bin histogram of a uint8 frame
+def histogram(frame):
+    return numpy.bincount(frame.ravel(), minlength=256)
+
+# it's really really dark: the pixel values hardly vary (std < threshold).
+# computed from the histogram so the frame isn't walked again
+def is_dark(hist, threshold=1.0):
+    levels = numpy.arange(256, dtype=numpy.float64)
+    n = float(hist.sum())
+    mean = numpy.dot(hist, levels) / n
+    variance = numpy.dot(hist, levels*levels) / n - mean*mean
+    return variance < threshold*threshold
+
+# lookup table that equalizes the histogram.
+# This reproduces histeq() from
+# http://www.janeriksolem.net/2009/06/histogram-equalization-with-python-and.html
+# that the night model was trained with: 256 bins spanning the min..max
+# pixel value and a linear interpolation of the cdf. The bins are filled
+# from the 256 level histogram, so only 256 values are ever interpolated
+def equalize_lut(hist):
+    levels = numpy.nonzero(hist)[0]
+    counts, bins = numpy.histogram(levels, 256, range=(levels[0], levels[-1]),
+                                   weights=hist[levels])
+    cdf = counts.cumsum()
+    cdf = 255.0 * cdf / cdf[-1]
+    return numpy.interp(numpy.arange(256), bins[:-1], cdf).astype(numpy.float32)
+
+# histogram equalize a uint8 frame with one take() through the lookup table.
+# returns a float32 frame (out if given)
+def equalize(frame, hist=None, out=None):
+    if hist is None:
+        hist = histogram(frame)
+    return equalize_lut(hist).take(frame, out=out)
+
+# the decode used before this module: full decode, convert, resize, crop
+def _load_frame_full(filename):
+    im = Image.open(filename).convert("L")
+    im = im.resize( (320, 240) )
+    im = im.crop( (0,0, 320, 220) )
+    return numpy.asarray(im)
+
+def benchmark(dirname, passes=3):
+    files = [os.path.join(dirname, f) for f in sorted(os.listdir(dirname))
+             if search(r"(.+)\.jpg", f) is not None]
+    if len(files) == 0:
+        print "no jpg files in " + dirname
+        return
+
+    out = numpy.empty(FRAME_SHAPE, dtype=numpy.uint8)
+    full = FrameSpec(decode='full')
+    draft = FrameSpec(decode='draft')
+    for name, load in (('before', _load_frame_full),
+                       ('full decode', lambda f: load_frame(f, out, full)),
+                       ('draft decode', lambda f: load_frame(f, out, draft))):
+        start = time()
+        for i in range(passes):
+            for filename in files:
+                load(filename)
+        elapsed = time() - start
+        print "%-12s %8.1f frames/sec (%d frames)" % (name, passes*len(files) / elapsed, passes*len(files))
+
+    # how far the draft pixels are from the ones the models were trained on
+    diffs = [numpy.abs(load_frame(f, spec=full).astype(numpy.int16) - load_frame(f, spec=draft))
+             for f in files]
+    print "draft vs full decode: mean abs difference %.2f, max %d grey levels" % \
+          (numpy.mean([d.mean() for d in diffs]), max(d.max() for d in diffs))
+
+def main():
+    parser = argparse.ArgumentParser(description='frames/sec of the jpg ingest')
+    parser.add_argument('dirname', nargs='?', default=None,
+                        help='directory of jpgs (default: camera.fakecam path)')
+    parser.add_argument('--passes', type=int, default=3)
+    args = parser.parse_args()
+    dirname = args.dirname
+    if dirname is None:
+        dirname = CONF.importOpt(module='camera.fakecam', name='path', group='camera.fakecam')
+    benchmark(dirname, args.passes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import common.log as logging
+import math
+from time import time
+import numpy
+
+logger = logging.getLogger()
+
+# learning rate schedules, rate of an epoch (counted from 0)
+SCHEDULES = ('constant', 'step', 'exponential', 'cosine')
+
+# learning rate of epoch for schedule:
+#   constant     rate
+#   step         rate * decay every step_epochs epochs
+#   exponential  rate * decay every epoch
+#   cosine       rate down to 0 along half a cosine over epochs
+def learning_rate(schedule, rate, epoch, epochs, decay=0.5, step_epochs=10):
+    if schedule == 'constant':
+        return rate
+    if schedule == 'step':
+        return rate * decay ** (epoch // max(step_epochs, 1))
+    if schedule == 'exponential':
+        return rate * decay ** epoch
+    if schedule == 'cosine':
+        return 0.5 * rate * (1.0 + math.cos(math.pi * epoch / max(epochs, 1)))
+    raise ValueError("Unknown learning rate schedule " + str(schedule))
+
+class SGD (object):
+    '''
+    SGD - stochastic gradient descent, with momentum if momentum > 0.
+
+    The velocity keeps momentum times the last step, so steps along a
+    direction the gradients agree on build up and noise cancels out.
+    '''
+    def __init__(self, momentum=0.0):
+        self.momentum = momentum
+        self.velocity = None
+
+    # update theta in place with the gradient of a batch
+    def step(self, theta, grad, rate):
+        if self.momentum > 0:
+            if self.velocity is None:
+                self.velocity = numpy.zeros_like(theta)
+            self.velocity *= self.momentum
+            self.velocity -= rate * grad
+            theta += self.velocity
+        else:
+            theta -= rate * grad
+
+class Adam (object):
+    '''
+    Adam - gradient steps scaled per weight by running gradient moments.
+
+    Kingma and Ba, "Adam: A Method for Stochastic Optimization". Every
+    weight moves by about rate, however large or small its gradients are.
+    '''
+    def __init__(self, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.m = None
+        self.v = None
+        self.t = 0
+
+    def step(self, theta, grad, rate):
+        if self.m is None:
+            self.m = numpy.zeros_like(theta)
+            self.v = numpy.zeros_like(theta)
+        self.t += 1
+        self.m *= self.beta1
+        self.m += (1.0 - self.beta1) * grad
+        self.v *= self.beta2
+        self.v += (1.0 - self.beta2) * grad * grad
+        # bias corrections folded into the rate
+        scaled = rate * math.sqrt(1.0 - self.beta2 ** self.t) / (1.0 - self.beta1 ** self.t)
+        theta -= scaled * self.m / (numpy.sqrt(self.v) + self.epsilon)
+
+# optimizer objects by name
+OPTIMIZERS = {'sgd': lambda momentum: SGD(0.0),
+              'momentum': lambda momentum: SGD(momentum),
+              'adam': lambda momentum: Adam()}
+
+# shuffled (X, Y) batches of one epoch. X is a matrix of the samples or a
+# dataset.ChunkedDataset, which is read a batch of rows at a time
+def batches(X, Y, batch_size, rng):
+    order = rng.permutation(X.shape[0])
+    for first in range(0, len(order), batch_size):
+        rows = numpy.sort(order[first:first+batch_size])
+        if hasattr(X, 'rows'):
+            yield X.rows(rows), Y[rows]
+        else:
+            yield X[rows], Y[rows]
+
+# train theta (updated in place) on mini-batches. cost_grad(theta, X, Y)
+# returns (J, gradient) of a batch. callback(epoch, loss) is called after
+# every epoch. returns the mean batch loss of every epoch
+def train(theta, X, Y, cost_grad, optimizer='adam', epochs=10, batch_size=64, rate=0.001,
+          schedule='constant', decay=0.5, step_epochs=10, momentum=0.9, seed=0, callback=None):
+    if optimizer not in OPTIMIZERS:
+        raise ValueError("Unknown mini-batch optimizer " + str(optimizer))
+    stepper = OPTIMIZERS[optimizer](momentum)
+    rng = numpy.random.RandomState(seed)
+    m = X.shape[0]
+    losses = list()
+    for epoch in range(epochs):
+        lr = learning_rate(schedule, rate, epoch, epochs, decay, step_epochs)
+        start = time()
+        loss = 0.0
+        for Xb, Yb in batches(X, Y, batch_size, rng):
+            J, grad = cost_grad(theta, Xb, Yb)
+            loss += J * Xb.shape[0]
+            stepper.step(theta, grad, lr)
+        loss /= m
+        elapsed = time() - start
+        losses.append(loss)
+        logger.info("epoch %d/%d: loss %.6f, learning rate %g, %.1f samples/s" %
+                    (epoch + 1, epochs, loss, lr, m / elapsed if elapsed > 0 else 0.0))
+        if callback is not None:
+            callback(epoch, loss)
+    return losses
@@ -0,0 +1,191 @@
+#!/bin/python
+"""
+Native model file for Predicter_NN.
+
+A .mat model has to be parsed and copied by scipy.io.loadmat in every
+process that uses it. A native model file is a small JSON header followed
+by the raw arrays, each one 64 byte aligned, already in the layout the
+inference engines use. load() numpy.memmaps the arrays read-only, so
+loading costs no parsing or copying and processes forked from the daemon
+share the same physical pages.
+
+  offset 0   'GEMODEL\\0'
+  offset 8   uint32 format version, uint32 header length (little endian)
+  offset 16  JSON header: kind, frame spec, training metadata and the
+             dtype/shape/offset of every array
+  ...        arrays
+
+kind is the weight_mode the arrays are laid out for (float32, int8 or
+sparse). Files are written to a temporary name and renamed into place, so
+a running predicter never maps a half written model.
+
+  python -m classifier.model_file convert ThetasV7.mat ThetasV7.model
+  python -m classifier.model_file info ThetasV7.model
+"""
+import common.log as logging
+import argparse
+import json
+import os
+import struct
+from time import strftime
+import numpy
+
+import ingest
+
+logger = logging.getLogger()
+
+MAGIC = 'GEMODEL\0'
+FORMAT_VERSION = 1
+ALIGN = 64
+# file name suffix of native models
+SUFFIX = '.model'
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+# True if filename starts with the native model magic
+def is_model_file(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+# write arrays (a dict of name -> ndarray) as a native model.
+# spec is the ingest.FrameSpec the model takes, meta a dict of training
+# metadata (anything json can store)
+def save(filename, kind, arrays, spec=ingest.DEFAULT_SPEC, meta=None):
+    header = {'kind': kind,
+              'roi': list(spec.roi),
+              'scale': spec.scale,
+              'decode': spec.decode,
+              'shape': list(spec.shape),
+              'meta': meta or dict(),
+              'arrays': dict()}
+    arrays = dict((name, numpy.ascontiguousarray(array)) for name, array in arrays.items())
+
+    # the offsets depend on the header length and the header holds the
+    # offsets, so lay out with a header size that is big enough for both
+    names = sorted(arrays)
+    for name in names:
+        header['arrays'][name] = {'dtype': arrays[name].dtype.str,
+                                  'shape': list(arrays[name].shape),
+                                  'offset': 0}
+    reserve = _aligned(16 + len(json.dumps(header)) + 32 * len(names) + ALIGN)
+    offset = reserve
+    for name in names:
+        header['arrays'][name]['offset'] = offset
+        offset = _aligned(offset + arrays[name].nbytes)
+    text = json.dumps(header)
+    if 16 + len(text) > reserve:
+        raise ValueError("model header does not fit in %d bytes" % reserve)
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', FORMAT_VERSION, len(text)))
+        f.write(text)
+        for name in names:
+            f.seek(header['arrays'][name]['offset'])
+            arrays[name].tofile(f)
+        f.truncate(offset)
+    os.rename(tmp, filename)
+
+# read a native model. returns (header, arrays) with the arrays memory
+# mapped read-only (mmap=False reads them into memory instead)
+def load(filename, mmap=True):
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(filename + " is not a native model file")
+        version, length = struct.unpack('<II', f.read(8))
+        if version != FORMAT_VERSION:
+            raise ValueError("%s has model format version %d, expected %d" %
+                             (filename, version, FORMAT_VERSION))
+        header = json.loads(f.read(length))
+        arrays = dict()
+        for name, info in header['arrays'].items():
+            dtype = numpy.dtype(str(info['dtype']))
+            shape = tuple(info['shape'])
+            if mmap:
+                arrays[str(name)] = numpy.memmap(filename, dtype=dtype, mode='r',
+                                                 offset=info['offset'], shape=shape)
+            else:
+                f.seek(info['offset'])
+                count = int(numpy.prod(shape))
+                arrays[str(name)] = numpy.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return (header, arrays)
+
+# frame spec a native model was built for. Models written before the
+# decode was recorded take the full decode
+def header_spec(header):
+    return ingest.FrameSpec(header['roi'], header['scale'], header.get('decode', 'full'))
+
+# load a native model and check it takes frames of spec
+def load_checked(filename, spec=ingest.DEFAULT_SPEC):
+    header, arrays = load(filename)
+    if header_spec(header) != spec:
+        raise ValueError("%s was built for %s, the predicter uses %s" %
+                         (filename, repr(header_spec(header)), repr(spec)))
+    return (header, arrays)
+
+# convert a Theta mat file into a native model laid out for weight_mode
+def convert(mat_file, out_file, weight_mode='float32', spec=ingest.DEFAULT_SPEC, keep=None):
+    import weight_cache
+    import nn_engine
+    import quantize
+    import prune
+    Theta1, Theta2 = weight_cache.load_thetas(mat_file)
+    if weight_mode == 'float32':
+        engine = nn_engine.NNEngine.from_thetas(Theta1, Theta2, spec.shape)
+    elif weight_mode == 'int8':
+        engine = quantize.QuantizedNNEngine.from_thetas(Theta1, Theta2, spec.shape)
+    elif weight_mode == 'sparse':
+        engine = prune.SparseNNEngine.from_thetas(Theta1, Theta2, spec.shape, keep=keep)
+    else:
+        raise ValueError("Unknown weight_mode " + str(weight_mode))
+
+    meta = {'source': os.path.abspath(mat_file),
+            'source_mtime': os.path.getmtime(mat_file),
+            'converted': strftime('%Y-%m-%d %H:%M:%S')}
+    if keep is not None and weight_mode == 'sparse':
+        meta['keep'] = keep
+    save(out_file, weight_mode, engine.arrays(), spec, meta)
+    print "%s -> %s (%s, %d bytes)" % (mat_file, out_file, weight_mode, os.path.getsize(out_file))
+
+def info(filename):
+    header, arrays = load(filename)
+    print "%s: %s model, roi %s scale %d, %s decode, frame %s" % \
+          (filename, header['kind'], str(tuple(header['roi'])), header['scale'],
+           header.get('decode', 'full'), str(tuple(header['shape'])))
+    for name in sorted(arrays):
+        print "  %-8s %-6s %s" % (name, arrays[name].dtype, str(arrays[name].shape))
+    for key in sorted(header['meta']):
+        print "  %s: %s" % (key, str(header['meta'][key]))
+
+def main():
+    parser = argparse.ArgumentParser(description='native model files for Predicter_NN')
+    commands = parser.add_subparsers(dest='command')
+    conv = commands.add_parser('convert', help='convert a Theta mat file')
+    conv.add_argument('mat_file')
+    conv.add_argument('out_file', help='output ' + SUFFIX + ' file')
+    conv.add_argument('--weight_mode', choices=('float32', 'int8', 'sparse'), default='float32')
+    conv.add_argument('--keep', type=float, default=None,
+                      help='sparse only: weights kept per hidden unit, a count or a fraction < 1')
+    conv.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX),
+                      help='roi the model was trained on: left upper right lower')
+    conv.add_argument('--roi_scale', type=int, default=1)
+    conv.add_argument('--decode', choices=ingest.DECODES, default='full',
+                         help='jpg decode the model was trained on')
+    inf = commands.add_parser('info', help='print the header of a native model')
+    inf.add_argument('filename')
+    args = parser.parse_args()
+
+    logging.setup(level='WARNING')
+    if args.command == 'convert':
+        convert(args.mat_file, args.out_file, args.weight_mode,
+                ingest.FrameSpec(args.roi, args.roi_scale, args.decode), args.keep)
+    else:
+        info(args.filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import common.log as logging
+import threading
+import numpy
+from ingest import FRAME_SHAPE
+
+logger = logging.getLogger()
+
+# numerically stable sigmoid computed in place.
+# clipping keeps exp() inside the float32 range, so no overflow warnings
+# have to be silenced and no temporaries are allocated
+def sigmoid_inplace(z):
+    numpy.clip(z, -80.0, 80.0, out=z)
+    numpy.negative(z, out=z)
+    numpy.exp(z, out=z)
+    z += 1.0
+    numpy.reciprocal(z, out=z)
+    return z
+
+class NNEngine (object):
+    '''
+    NNEngine - float32 evaluator for the 3 layer network.
+
+    W1 is (input+1) x hidden with the bias folded in as row 0. The input rows
+    follow the C order flatten of the frame, so a frame from numpy.asarray()
+    can be copied straight into the input buffer. W2 is (hidden+1) x output,
+    bias in row 0. The input/hidden/output buffers are allocated once per
+    thread and only grow when a bigger batch comes in.
+    '''
+    def __init__(self, W1, W2, shape=FRAME_SHAPE):
+        self.W1 = W1
+        self.W2 = W2
+        self.shape = shape
+        self.input_size = W1.shape[0] - 1
+        self.hidden_size = W1.shape[1]
+        self.output_size = W2.shape[1]
+        self.buffers = threading.local()
+
+    # build the engine from the Theta1/Theta2 matrices used by the trainer.
+    # Theta1 columns are in the Fortran order flatten of the frame; they are
+    # permuted once here so the per frame flatten('F') copy goes away
+    @classmethod
+    def from_thetas(cls, Theta1, Theta2, shape=FRAME_SHAPE):
+        Theta1 = numpy.asarray(Theta1)
+        Theta2 = numpy.asarray(Theta2)
+        rows, cols = shape
+        hidden = Theta1.shape[0]
+        if Theta1.shape[1] != rows*cols + 1:
+            raise ValueError("Theta1 has %d columns, expected %d for a %dx%d frame" %
+                             (Theta1.shape[1], rows*cols + 1, cols, rows))
+
+        W1 = numpy.empty((rows*cols + 1, hidden), dtype=numpy.float32)
+        W1[0] = Theta1[:, 0]
+        W1[1:] = Theta1[:, 1:].reshape(hidden, cols, rows).transpose(2, 1, 0).reshape(rows*cols, hidden)
+        W2 = numpy.ascontiguousarray(Theta2.T, dtype=numpy.float32)
+        return cls(W1, W2, shape)
+
+    # the float64 Theta1/Theta2 of the trainer back, undoing from_thetas
+    def to_thetas(self):
+        rows, cols = self.shape
+        hidden = self.hidden_size
+        Theta1 = numpy.empty((hidden, rows*cols + 1), dtype=numpy.float64)
+        Theta1[:, 0] = self.W1[0]
+        Theta1[:, 1:] = numpy.asarray(self.W1[1:]).reshape(rows, cols, hidden).transpose(2, 1, 0).reshape(hidden, rows*cols)
+        return (Theta1, numpy.array(self.W2, dtype=numpy.float64).T)
+
+    # arrays stored in a native model file (see model_file.py)
+    def arrays(self):
+        return {'W1': self.W1, 'W2': self.W2}
+
+    @classmethod
+    def from_arrays(cls, arrays, shape=FRAME_SHAPE):
+        return cls(arrays['W1'], arrays['W2'], shape)
+
+    def _get_buffers(self, m):
+        b = self.buffers
+        if getattr(b, 'size', 0) < m:
+            b.input = numpy.empty((m, self.input_size + 1), dtype=numpy.float32)
+            b.input[:, 0] = 1.0
+            b.hidden = numpy.empty((m, self.hidden_size), dtype=numpy.float32)
+            b.output = numpy.empty((m, self.output_size), dtype=numpy.float32)
+            b.size = m
+        return (b.input[:m], b.hidden[:m], b.output[:m])
+
+    # frames is an m x input array or a sequence of m frames (any shape
+    # with input elements in C order, any numeric dtype).
+    # returns an m x output float64 array of confidences
+    def forward(self, frames):
+        m = len(frames)
+        X, hidden, output = self._get_buffers(m)
+        if isinstance(frames, numpy.ndarray):
+            X[:, 1:] = frames.reshape(m, self.input_size)
+        else:
+            for row, frame in enumerate(frames):
+                X[row, 1:] = numpy.ravel(frame)
+
+        numpy.dot(X, self.W1, out=hidden)
+        sigmoid_inplace(hidden)
+        numpy.dot(hidden, self.W2[1:], out=output)
+        output += self.W2[0]
+        sigmoid_inplace(output)
+        return output.astype(numpy.float64)
@@ -2,6 +2,30 @@ import common.log as logging
 import common.config as Conf
 import os, sys, signal, errno
 
+class Prediction (tuple):
+    '''
+    Prediction - (closed, confidence) of one picture.
+
+    Unpacks like the plain tuple the predicters always returned; version
+    additionally names the model that produced it (None if unknown).
+    skipped is set when the picture itself was not classified: it is the
+    frame whose result was reused for it (see change_gate.ChangeGate).
+    '''
+    def __new__(cls, closed, confidence, version=None, skipped=None):
+        prediction = super(Prediction, cls).__new__(cls, (closed, confidence))
+        prediction.version = version
+        prediction.skipped = skipped
+        return prediction
+
+    def __getnewargs__(self):
+        return (self[0], self[1], self.version, self.skipped)
+
+    def __repr__(self):
+        text = "Prediction(closed=%s, confidence=%s, version=%s" % (self[0], self[1], self.version)
+        if self.skipped is not None:
+            text += ", skipped=%s" % self.skipped
+        return text + ")"
+
 class Predicter (object):
     def __init__(self):
         self.path = ""
@@ -1,19 +1,20 @@
 import common.log as logging
 import common.config as Conf
-import os
 #signal, errno
 import predict
+import weight_cache
+import nn_engine
+import quantize
+import prune
+import ingest
+import model_file
+import result_cache
+import change_gate
+import daylight
 
-from time import localtime
-from datetime import time
-from re import match
 #from os import listdir, path, makedirs
-from exceptions import RuntimeWarning
-from warnings import simplefilter
-from scipy import io
 #from shutil import move
 import numpy
-import Image
 from sys import _getframe
 
 
@@ -30,7 +31,62 @@ Options = [
                  group   = 'classifier.Predicter_NN',
                  default = '$HOME/.garageeye/default.mat',
                  help    = 'absolute path to mat file format including the filename'),
-
+    Conf.IntOpt(name    = 'reload_interval',
+                group   = 'classifier.Predicter_NN',
+                default = 10,
+                help    = 'seconds between checks of mat_file/nmat_file for a newer model'),
+    Conf.IntOpt(name    = 'batch_size',
+                group   = 'classifier.Predicter_NN',
+                default = 32,
+                help    = 'max number of frames stacked into one matrix by predict_batch'),
+    Conf.StrOpt(name    = 'weight_mode',
+                group   = 'classifier.Predicter_NN',
+                default = 'float32',
+                help    = 'how the weights are held in memory. options are: float32, int8, sparse'),
+    Conf.ListOpt(name    = 'roi',
+                 group   = 'classifier.Predicter_NN',
+                 default = list(ingest.CROP_BOX),
+                 help    = 'region of interest fed to the network: left upper right lower, in 320x240 picture coordinates'),
+    Conf.IntOpt(name    = 'roi_scale',
+                group   = 'classifier.Predicter_NN',
+                default = 1,
+                help    = 'integer downscale factor applied to the region of interest'),
+    Conf.StrOpt(name    = 'decode',
+                group   = 'classifier.Predicter_NN',
+                default = 'full',
+                help    = 'jpg decode: full (what the models were trained on) or draft (decodes at the reduced scale, several times faster, needs a model trained with it)'),
+    Conf.IntOpt(name    = 'cache_size',
+                group   = 'classifier.Predicter_NN',
+                default = 1024,
+                help    = 'number of prediction results kept in the content hash LRU cache. 0 disables it'),
+    Conf.FileOpt(name    = 'cache_file',
+                 group   = 'classifier.Predicter_NN',
+                 default = None,
+                 help    = 'optional file the prediction result cache is persisted to'),
+    Conf.FloatOpt(name    = 'change_threshold',
+                  group   = 'classifier.Predicter_NN',
+                  default = 0.0,
+                  help    = 'mean grey level difference to the last classified frame below which predict() reuses its result (e.g. 2.0). only for a stream of consecutive frames of one camera. 0 (the default) disables the change gate'),
+    Conf.IntOpt(name    = 'change_max_skip',
+                group   = 'classifier.Predicter_NN',
+                default = 30,
+                help    = 'max number of frames in a row the change gate may skip (0 means no limit)'),
+    Conf.FloatOpt(name    = 'latitude',
+                  group   = 'classifier.Predicter_NN',
+                  default = None,
+                  help    = 'latitude of the camera in degrees (north positive). picks the day or night model by the sunrise/sunset at that place. without it day is 6:00-18:00'),
+    Conf.FloatOpt(name    = 'longitude',
+                  group   = 'classifier.Predicter_NN',
+                  default = None,
+                  help    = 'longitude of the camera in degrees (east positive)'),
+    Conf.IntOpt(name    = 'sunrise_offset',
+                group   = 'classifier.Predicter_NN',
+                default = -20,
+                help    = 'minutes added to the sunrise time before the day model is used'),
+    Conf.IntOpt(name    = 'sunset_offset',
+                group   = 'classifier.Predicter_NN',
+                default = 30,
+                help    = 'minutes added to the sunset time before the night model is used'),
 ]
 
 logger = logging.getLogger()
@@ -38,132 +94,290 @@ CONF = Conf.Config
 CONF.registerOpt(Options)
 
 
-# sigmoid function
-def sigmoid(z):
-  onesMatrix = numpy.ones( z.shape )
-  simplefilter("ignore", RuntimeWarning)
-  rval = numpy.exp(-z)
-  simplefilter("default", RuntimeWarning)
-  rval = onesMatrix / (onesMatrix + rval)
-  return rval
+# load a float32 native model (memory mapped) or a mat file and turn it
+# into a float32 inference engine.
+# spec is the ingest.FrameSpec the model was trained on
+def load_engine(filename, spec=ingest.DEFAULT_SPEC):
+    if model_file.is_model_file(filename):
+        header, arrays = model_file.load_checked(filename, spec)
+        if header['kind'] != 'float32':
+            raise ValueError("%s is a %s model, set weight_mode to match" % (filename, header['kind']))
+        return nn_engine.NNEngine.from_arrays(arrays, spec.shape)
+    Theta1, Theta2 = weight_cache.load_thetas(filename)
+    return nn_engine.NNEngine.from_thetas(Theta1, Theta2, spec.shape)
 
-# from
-# http://www.janeriksolem.net/2009/06/histogram-equalization-with-python-and.html
-def histeq(im,nbr_bins=256):
-    #get image histogram
-    imhist,bins = numpy.histogram(im.flatten(),nbr_bins,normed=True)
-    cdf = imhist.cumsum() #cumulative distribution function
-    cdf = 255 * cdf / cdf[-1] #normalize
-
-    #use linear interpolation of cdf to find new pixel values
-    im2 = numpy.interp(im.flatten(),bins[:-1],cdf)
-
-    im2 = im2.reshape(im.shape)
-    return numpy.matrix(im2, dtype=numpy.float64)
+# loader used by the weight caches for each weight_mode
+ENGINE_LOADERS = {'float32': load_engine,
+                  'int8': quantize.load_engine,
+                  'sparse': prune.load_engine}
 
+# a new model is only switched to if it runs on a blank frame and gives a
+# finite confidence
+def validate_engine(engine, spec=ingest.DEFAULT_SPEC):
+    confidence = engine.forward([numpy.zeros(spec.shape, dtype=numpy.uint8)])
+    if confidence.shape != (1, 1) or not numpy.all(numpy.isfinite(confidence)):
+        raise ValueError("model gives %s on a blank frame" % str(confidence))
 
 class Predicter_NN (predict.Predicter):
-    def __init__(self, mat_file, nmat_file):
+    def __init__(self, mat_file, nmat_file, reload_interval=10, batch_size=32,
+                 weight_mode='float32', spec=ingest.DEFAULT_SPEC, cache_size=1024, cache_file=None,
+                 change_threshold=0.0, change_max_skip=30, daylight_oracle=None):
         super(Predicter_NN, self).__init__()
         self.mat_file = mat_file
         self.nmat_file = nmat_file
+        self.batch_size = batch_size
+        self.spec = spec
+        self.weight_mode = weight_mode
+        self.daylight = daylight_oracle or daylight.DaylightOracle()
+        if weight_mode not in ENGINE_LOADERS:
+            raise ValueError("Unknown weight_mode " + str(weight_mode))
+        loader = lambda filename: ENGINE_LOADERS[weight_mode](filename, spec)
+        validate = lambda engine: validate_engine(engine, spec)
+        # both models stay resident. the caches only stat the files (or
+        # models directories) to pick up a retrained model, and swap it in
+        # between frames
+        key = (weight_mode, spec.roi, spec.scale, spec.decode)
+        self.day_weights = weight_cache.REGISTRY.cache(mat_file, key, loader, reload_interval, validate)
+        self.night_weights = weight_cache.REGISTRY.cache(nmat_file, key, loader, reload_interval, validate)
+        # results of pictures already classified by the current models
+        self.results = None
+        if cache_size > 0:
+            self.results = result_cache.ResultCache(cache_size, cache_file)
+        # reuses the last result of predict() while the scene is static.
+        # off unless configured: the frames have to be one camera stream
+        self.gate = None
+        if change_threshold > 0:
+            self.gate = change_gate.ChangeGate(change_threshold, change_max_skip, spec)
 
-    def load_image (self, filename):
-        im = Image.open(filename).convert("L")
-        im = im.resize( (320, 240) )
-        im = im.crop( (0,0, 320, 220) )
-        return im
+    def load_image (self, filename, out=None):
+        return ingest.load_frame(filename, out, self.spec)
 
-    def dayPredict(self, filename):
-        imageX = numpy.matrix(self.load_image(filename), \
-             dtype=numpy.float64)
-        imageX = imageX.flatten('F')
+    # engine is the day model to use, by default the current one
+    def dayPredict(self, filename, engine=None):
+        imageX = numpy.asarray(self.load_image(filename))
 
-        try:
-            x=io.loadmat(self.mat_file, None, False)
-        except:
+        if engine is None:
+            engine = self.day_weights.get()
+        if engine is None:
             logger.error("Load mat failed")
             logger.debug("Load mat file path set to:" + str(self.mat_file))
             return 0
 
-        Theta1 = x['Theta1']
-        Theta2 = x['Theta2']
-        confidence = self.calculateSigmoid(Theta1, Theta2, imageX)
+        confidence = engine.forward([imageX])
         if (confidence[0,0] > 0.5):
             logger.debug(filename + "\t(" + str(confidence[0,0]) + ") \t[closed]")
         if (confidence[0,0] <= 0.5):
             logger.debug(filename + "\t(" + str(confidence[0,0]) + ") \t[opened]")
         return confidence
 
-    def nightPredict(self, filename):
-        imageX = numpy.matrix(self.load_image(filename), \
-                              dtype=numpy.float64)
+    def nightPredict(self, filename, engine=None):
+        imageX = self.load_image(filename)
+        hist = ingest.histogram(imageX)
 
         # it's really really dark.
-        if (numpy.std(imageX.flatten('F')) < 1.0):
+        if ingest.is_dark(hist):
             logger.debug(filename + "\t(0.99999999)\t[closed]")
             return 0.999
 
-        imageX = histeq(imageX)
-        imageX = imageX.flatten('F')
+        imageX = ingest.equalize(imageX, hist)
 
-        try:
-            x=io.loadmat(self.nmat_file, None, False)
-        except:
+        if engine is None:
+            engine = self.night_weights.get()
+        if engine is None:
             logger.error("Load mat failed")
+            logger.debug("Load mat file path set to:" + str(self.nmat_file))
             return 0
 
-        Theta1 = x['Theta1']
-        Theta2 = x['Theta2']
-        confidence = self.calculateSigmoid(Theta1, Theta2, imageX)
+        confidence = engine.forward([imageX])
         if (confidence[0,0] > 0.5):
             logger.debug(filename + "\t(" + str(confidence[0,0]) + ") \t[closed]")
         if (confidence[0,0] <= 0.5):
             logger.debug(filename + "\t(" + str(confidence[0,0]) + ") \t[opened]")
         return confidence
 
-    # 3 layer NN
-    # 320x240 array input layer
-    # 50 node hidden layer
-    # 1 output layer
-    def calculateSigmoid(self, Theta1, Theta2, X):
-        m = X.shape[0]
-        num_labels = Theta2.shape[0]
-        onesMat = numpy.ones( (m, 1), dtype=numpy.float64 )
-        h1 = sigmoid(numpy.dot (numpy.hstack((onesMat, X)), Theta1.T))
-        h2 = sigmoid(numpy.dot (numpy.hstack((onesMat, h1)), Theta2.T))
-        return h2
+    # True if the picture was taken during the day. The time comes from the
+    # yyyymmdd_hhmm_ss.jpg filename, otherwise the current local time is used
+    def isDayTime (self, filename):
+        return self.daylight.is_daytime_file(filename)
+
+    # the current day and night weight_cache.Model, taken once per frame
+    # or batch so a model switch never happens halfway through
+    def models (self):
+        return {True: self.day_weights.get_model(), False: self.night_weights.get_model()}
+
+    # identifies the model a picture is classified with. changes whenever
+    # a new model is switched to, so cached results of an older model miss
+    def model_version (self, is_day, model):
+        return (is_day, self.weight_mode, self.spec.roi, self.spec.scale, self.spec.decode,
+                model.version if model is not None else None)
+
+    # result cache key of filename or None if the cache is off or the file
+    # cannot be read
+    def cache_key (self, filename, version):
+        if self.results is None:
+            return None
+        try:
+            return self.results.key(filename, version)
+        except (IOError, OSError) as ex:
+            logger.debug(ex)
+            return None
+
+    def cache_stats (self):
+        if self.results is None:
+            return None
+        return self.results.stats()
 
+    def gate_stats (self):
+        if self.gate is None:
+            return None
+        return self.gate.stats()
+
+    # returns a predict.Prediction: (closed, confidence) plus the version
+    # of the model that produced it
     def predictImage (self, filename):
-        def _isDayTime(currentTime):
-          dt = time(hour = currentTime[0], minute = currentTime[1])
-          sunrise = time(hour=6, minute=0)
-          sunset = time(hour=18, minute=0)
-          return ((dt > sunrise) and (dt < sunset))
-        
-        # get the current local time and extract the hour, min
-        currTime = localtime()[3:5]
-        (path, file) = os.path.split(filename)
-        matobj = match(r"(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})_(\d{2}).jpg", file)
-        if matobj is not None:
-          currTime = (int(matobj.group(4)), int(matobj.group(5)))
-          
-        if _isDayTime(currTime):
-          confidence = self.dayPredict(filename)
+        is_day = self.isDayTime(filename)
+        model = self.models()[is_day]
+        version = self.model_version(is_day, model)
+        key = self.cache_key(filename, version)
+        if key is not None:
+            cached = self.results.get(key)
+            if cached is not None:
+                logger.debug(filename + "\t(" + str(cached[1]) + ") \t[cached]")
+                return cached
+
+        signature = None
+        if self.gate is not None:
+            signature = self.gate.signature(filename)
+            reused = self.gate.lookup(signature, version)
+            if reused is not None:
+                last, source = reused
+                logger.debug(filename + "\t(" + str(last[1]) + ") \t[skipped, as " + str(source) + "]")
+                return predict.Prediction(last[0], last[1], last.version, skipped=source)
+
+        engine = model.weights if model is not None else None
+        if is_day:
+          confidence = self.dayPredict(filename, engine)
         else:
-          confidence = self.nightPredict(filename)
+          confidence = self.nightPredict(filename, engine)
 
         closed = True
         if confidence < 0.5:
           closed = False
 
-        return (closed, confidence)
+        if model is None:
+            return predict.Prediction(closed, confidence)
+        result = predict.Prediction(closed, float(numpy.ravel(confidence)[0]), model.version)
+        if key is not None:
+            self.results.put(key, result)
+        if signature is not None:
+            self.gate.update(signature, version, result, filename)
+        return result
+
+    # run one matrix multiply per model over a stack of frames.
+    # images is a sequence of uint8 frames of self.spec.shape (220x320 unless
+    # a roi is configured), daytime a sequence of
+    # the same length telling which model to use for each frame and models
+    # the snapshot of models() to use (the current models by default).
+    # returns a list of predict.Prediction, None where the model is missing
+    def predict_array_batch (self, images, daytime, batch_size=None, models=None):
+        batch_size = batch_size or self.batch_size
+        models = models or self.models()
+        results = [None] * len(images)
+
+        for is_day, cache in ((True, self.day_weights), (False, self.night_weights)):
+            indexes = [i for i in range(len(images)) if bool(daytime[i]) == is_day]
+            if len(indexes) == 0:
+                continue
+            model = models[is_day]
+            if model is None:
+                logger.error("Load mat failed")
+                logger.debug("Load mat file path set to:" + str(cache.filename))
+                continue
+            engine = model.weights
+
+            for start in range(0, len(indexes), batch_size):
+                chunk = indexes[start:start+batch_size]
+                frames = list()
+                rows = list()
+                for i in chunk:
+                    imageX = numpy.asarray(images[i], dtype=numpy.uint8)
+                    if not is_day:
+                        hist = ingest.histogram(imageX)
+                        # it's really really dark.
+                        if ingest.is_dark(hist):
+                            results[i] = predict.Prediction(True, 0.999, model.version)
+                            continue
+                        imageX = ingest.equalize(imageX, hist)
+                    frames.append(imageX)
+                    rows.append(i)
+                if len(rows) == 0:
+                    continue
+
+                # 3 layer NN: roi sized input layer, 50 node hidden layer, 1 output
+                confidence = engine.forward(frames)
+                for row, i in enumerate(rows):
+                    results[i] = predict.Prediction(confidence[row,0] >= 0.5, float(confidence[row,0]),
+                                                    model.version)
+        return results
+
+    # batched version of predictImage. Frames are loaded batch_size at a
+    # time so memory stays bounded however many files are passed in.
+    # Pictures found in the result cache are not decoded at all.
+    # returns a list of predict.Prediction, None for files that failed
+    def predict_batch (self, filenames, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        results = list()
+        for start in range(0, len(filenames), batch_size):
+            chunk = filenames[start:start+batch_size]
+            models = self.models()
+            chunk_results = [None] * len(chunk)
+            images = numpy.empty((len(chunk),) + self.spec.shape, dtype=numpy.uint8)
+            daytime = list()
+            loaded = list()
+            keys = list()
+            for index, filename in enumerate(chunk):
+                is_day = self.isDayTime(filename)
+                key = self.cache_key(filename, self.model_version(is_day, models[is_day]))
+                if key is not None:
+                    cached = self.results.get(key)
+                    if cached is not None:
+                        chunk_results[index] = cached
+                        continue
+                try:
+                    self.load_image(filename, images[len(loaded)])
+                except IOError as ex:
+                    logger.error("Load image failed: " + filename)
+                    logger.debug(ex)
+                    continue
+                daytime.append(is_day)
+                loaded.append(index)
+                keys.append(key)
+
+            for index, key, result in zip(loaded, keys, self.predict_array_batch(images[:len(loaded)], daytime, batch_size, models)):
+                chunk_results[index] = result
+                if key is not None and result is not None:
+                    self.results.put(key, result)
+            results.extend(chunk_results)
+        if self.results is not None:
+            self.results.save()
+            logger.debug("result cache: " + str(self.results.stats()))
+        return results
 
     def predict(self, filename):
         logger.debug(_getframe().f_code.co_name + ' called')
-        self.predictImage(filename)
+        return self.predictImage(filename)
 
     @staticmethod
     def factory (conf_vars):
-        return Predicter_NN(conf_vars['mat_file'], conf_vars['nmat_file'])
+        return Predicter_NN(conf_vars['mat_file'], conf_vars['nmat_file'],
+                            reload_interval=conf_vars['reload_interval'],
+                            batch_size=conf_vars['batch_size'],
+                            weight_mode=conf_vars['weight_mode'],
+                            spec=ingest.FrameSpec.from_conf(conf_vars['roi'], conf_vars['roi_scale'], conf_vars['decode']),
+                            cache_size=conf_vars['cache_size'],
+                            cache_file=conf_vars['cache_file'],
+                            change_threshold=conf_vars['change_threshold'],
+                            change_max_skip=conf_vars['change_max_skip'],
+                            daylight_oracle=daylight.DaylightOracle(conf_vars['latitude'], conf_vars['longitude'],
+                                                                    conf_vars['sunrise_offset'], conf_vars['sunset_offset']))
 
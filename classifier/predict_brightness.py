@@ -0,0 +1,58 @@
+import common.log as logging
+import common.config as Conf
+import predict
+import ingest
+
+import numpy
+from sys import _getframe
+
+
+Options = [
+    Conf.StrOpt(name    = 'use',
+                group   = 'classifier.Predicter_Brightness',
+                default = 'classifier.predict_brightness:Predicter_Brightness.factory',
+                help    = 'point to the brightness heuristic used to predict results'),
+    Conf.FloatOpt(name    = 'dark_std',
+                  group   = 'classifier.Predicter_Brightness',
+                  default = 1.0,
+                  help    = 'grey level std of the roi thumbnail below which the garage is dark and the door closed'),
+    Conf.ListOpt(name    = 'roi',
+                 group   = 'classifier.Predicter_Brightness',
+                 default = list(ingest.CROP_BOX),
+                 help    = 'region of interest looked at: left upper right lower, in 320x240 picture coordinates'),
+]
+
+logger = logging.getLogger()
+CONF = Conf.Config
+CONF.registerOpt(Options)
+
+
+class Predicter_Brightness (predict.Predicter):
+    '''
+    Predicter_Brightness - first stage for a cascade (see cascade.py).
+
+    Only looks at a 1/8 scale thumbnail of the roi. When the pixel values
+    hardly vary the garage is dark, which only happens with the door closed,
+    and it answers closed with 0.999 like the night model does. Anything
+    else is answered with 0.5, i.e. "don't know", so the cascade moves on.
+    '''
+    def __init__(self, dark_std=1.0, spec=ingest.DEFAULT_SPEC):
+        super(Predicter_Brightness, self).__init__()
+        self.dark_std = dark_std
+        self.spec = spec
+
+    def predictImage (self, filename):
+        thumbnail = ingest.load_thumbnail(filename, self.spec)
+        if numpy.std(thumbnail) < self.dark_std:
+            logger.debug(filename + "\t(0.999)\t[closed]")
+            return (True, 0.999)
+        return (False, 0.5)
+
+    def predict(self, filename):
+        logger.debug(_getframe().f_code.co_name + ' called')
+        return self.predictImage(filename)
+
+    @staticmethod
+    def factory (conf_vars):
+        return Predicter_Brightness(dark_std=conf_vars['dark_std'],
+                                    spec=ingest.FrameSpec.from_conf(conf_vars['roi']))
@@ -2,6 +2,8 @@ import common.config as Conf
 import common.log as logging
 
 import predict_NN
+import weight_cache
+import cascade
 
 CONF = Conf.Config
 logger = logging.getLogger()
@@ -23,6 +25,7 @@ class PredictionManager (object):
     def __init__ (self):
         self.predicters = dict()
         self.trainers=dict()
+        self.cascade = None
 
     def setup (self):
         # get list of predicters
@@ -48,6 +51,42 @@ class PredictionManager (object):
             logger.info("Call trainer and init the class")
             self.trainers[trainer_name] = call_use_function(use, conf_vars)
 
+        stage_names = CONF.importOpt(module='time_lapse_manager', name='cascade', group='app')
+        if stage_names:
+            band = CONF.importOpt(module='time_lapse_manager', name='cascade_band', group='app')
+            self.cascade = self.build_cascade(stage_names, band)
+
+    # stage_names are predicters set up from the classifier list, cheapest
+    # first. band is one (low, high) pair for every stage or one per stage
+    def build_cascade (self, stage_names, band):
+        band = [float(x) for x in band]
+        if len(band) == 2:
+            band = band * len(stage_names)
+        if len(band) != 2 * len(stage_names):
+            raise ValueError("cascade_band needs 2 or %d values, got %d" % (2 * len(stage_names), len(band)))
+        stages = list()
+        for index, name in enumerate(stage_names):
+            if name not in self.predicters:
+                raise ValueError("cascade stage %s is not in the classifier list" % name)
+            stages.append(cascade.Stage(name, self.predicters[name], band[2*index], band[2*index+1]))
+        logger.info("Cascade: " + " -> ".join(stage_names))
+        return cascade.Cascade(stages)
+
+    # classify filename with the cascade if one is configured, else with the
+    # first classifier. returns (closed, confidence) or None
+    def predict (self, filename):
+        if self.cascade is not None:
+            return self.cascade.predict(filename)
+        predictor_names = CONF.importOpt(module='time_lapse_manager', name='classifier', group='app')
+        if len(predictor_names) > 0 and predictor_names[0] in self.predicters:
+            return self.predicters[predictor_names[0]].predict(filename)
+        return None
+
+    # model file -> version currently used for it, for monitoring. Models
+    # are switched by the predicters themselves when a new one shows up
+    def model_versions (self):
+        return weight_cache.REGISTRY.versions()
+
     def get (self, name):
         if name in self.predicters:
             return self.predicters[name]
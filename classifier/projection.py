@@ -0,0 +1,172 @@
+#!/bin/python
+"""
+Feature reduction ahead of the hidden layer.
+
+Train_NN can project the pixel vector (Fortran order flatten of the frame,
+like the rest of the trainer) down to k features before running fmin_cg,
+either with a PCA fit on the training set or with a fixed seeded random
+projection. The projection is saved in the mat file next to Theta1/Theta2.
+
+When a model is loaded for prediction the projection is folded into
+Theta1 (Theta1 * P^T), so the predicters keep evaluating one pixel sized
+matrix multiply. Keeping it as a separate x*P step would cost input*k
+instead of input*hidden multiplies, which is more for any k above the 50
+hidden units.
+
+  python -m classifier.projection report <labeled dir> --k 16 32 64 128
+
+trains a model for each k and prints the accuracy/latency tradeoff.
+"""
+import common.log as logging
+import argparse
+from time import time
+import numpy
+
+import ingest
+import evaluate
+import dataset
+from feature_cache import FeatureCache
+
+logger = logging.getLogger()
+
+PROJECTIONS = ('none', 'pca', 'random')
+
+class Projection (object):
+    '''
+    Projection - x -> (x - mean) * P where P is input x k.
+
+    kind is 'pca' or 'random'. A random projection is fully defined by its
+    seed and size, so only those are saved for it.
+    '''
+    def __init__(self, P, mean, kind, seed=None):
+        self.P = P
+        self.mean = mean
+        self.kind = kind
+        self.seed = seed
+        self.input_size, self.k = P.shape
+
+    # principal components of the training rows. The eigenvectors are taken
+    # from the m x m Gram matrix, which is far smaller than the input x input
+    # covariance for the few thousand frames of a training set
+    @classmethod
+    def fit_pca(cls, X, k):
+        X = numpy.asarray(X, dtype=numpy.float64)
+        mean = X.mean(axis=0)
+        Xc = X - mean
+        w, U = numpy.linalg.eigh(numpy.dot(Xc, Xc.T))
+        order = numpy.argsort(w)[::-1][:k]
+        order = order[w[order] > 1e-9 * w[order[0]]]
+        if len(order) < k:
+            logger.warning("PCA: only %d of %d components are non zero" % (len(order), k))
+        P = numpy.dot(Xc.T, U[:, order]) / numpy.sqrt(w[order])
+        return cls(P.astype(numpy.float32), mean.astype(numpy.float32), 'pca')
+
+    @classmethod
+    def random(cls, input_size, k, seed=0):
+        rng = numpy.random.RandomState(seed)
+        P = rng.standard_normal((input_size, k)) / numpy.sqrt(k)
+        return cls(P.astype(numpy.float32), numpy.zeros(input_size, dtype=numpy.float32),
+                   'random', seed)
+
+    @classmethod
+    def fit(cls, kind, X, k, seed=0):
+        if kind == 'pca':
+            return cls.fit_pca(X, k)
+        if kind == 'random':
+            return cls.random(X.shape[1], k, seed)
+        raise ValueError("Unknown projection " + str(kind))
+
+    # m x input rows -> m x k features
+    def apply(self, X):
+        return numpy.dot(X, self.P) - numpy.dot(self.mean, self.P)
+
+    # Theta1 trained on the k features -> Theta1 on the raw input
+    def fold(self, Theta1):
+        Theta1 = numpy.asarray(Theta1)
+        W = numpy.dot(Theta1[:, 1:], self.P.T)
+        bias = Theta1[:, 0] - numpy.dot(W, self.mean)
+        return numpy.hstack((bias[:, numpy.newaxis], W))
+
+    # variables stored in the mat file next to Theta1/Theta2
+    def to_mat_vars(self):
+        if self.kind == 'random':
+            return {'proj_kind': self.kind, 'proj_seed': self.seed,
+                    'proj_size': numpy.array([self.input_size, self.k])}
+        return {'proj_kind': self.kind, 'proj_P': self.P, 'proj_mean': self.mean}
+
+    # the projection saved in a loadmat() dictionary, None if there is none
+    @classmethod
+    def from_mat_vars(cls, x):
+        if 'proj_kind' not in x:
+            return None
+        kind = str(numpy.asarray(x['proj_kind']).ravel()[0])
+        if kind == 'random':
+            input_size, k = numpy.asarray(x['proj_size']).ravel()
+            return cls.random(int(input_size), int(k), int(numpy.asarray(x['proj_seed']).ravel()[0]))
+        return cls(x['proj_P'], numpy.asarray(x['proj_mean']).ravel(), kind)
+
+# train a model per k on 3/4 of the labeled frames and test on the rest.
+# prints training time, accuracy and per frame latency for each k
+def report(dirname, ks, kind='pca', iterations=16, spec=ingest.DEFAULT_SPEC, baseline=False,
+           feature_cache=None):
+    import train_NN
+    import nn_engine
+    files, labels = evaluate.labeled_files(dirname)
+    if len(files) < 4:
+        print "need at least 4 labeled jpg files under " + dirname
+        return
+
+    trainer = train_NN.Train_NN(dirname, spec=spec)
+    cache = FeatureCache(feature_cache, spec) if feature_cache else None
+    X = numpy.asmatrix(dataset.load_dataset(files, spec, cache=cache))
+    Y = numpy.matrix(labels, dtype=numpy.float64).T
+    test = numpy.arange(len(files)) % 4 == 3
+    frame = ingest.load_frame(files[0], spec=spec)
+
+    print "%-8s %8s %12s %10s %10s %14s" % ('k', 'fit s', 's/iteration', 'train acc', 'test acc', 'ms/frame')
+    for k in ([None] if baseline else []) + list(ks):
+        start = time()
+        if k is None:
+            projection = None
+            Xtrain = X
+        else:
+            projection = Projection.fit(kind, X[~test], k)
+            Xtrain = numpy.matrix(projection.apply(X))
+        Theta1, Theta2 = trainer.fit(Xtrain[~test], Y[~test], iterations)
+        elapsed = time() - start
+        train_acc = numpy.mean((trainer.predict(Theta1, Theta2, Xtrain[~test]) > 0.5) == Y[~test])
+        test_acc = numpy.mean((trainer.predict(Theta1, Theta2, Xtrain[test]) > 0.5) == Y[test])
+
+        if projection is not None:
+            Theta1 = projection.fold(Theta1)
+        engine = nn_engine.NNEngine.from_thetas(Theta1, Theta2, spec.shape)
+        start = time()
+        for i in range(20):
+            engine.forward([frame])
+        latency = (time() - start) / 20
+
+        print "%-8s %8.2f %12.3f %10.4f %10.4f %14.2f" % \
+              ('none' if k is None else str(k), elapsed, elapsed / max(trainer.iterCount - 1, 1),
+               train_acc, test_acc, latency*1000.0)
+
+def main():
+    parser = argparse.ArgumentParser(description='accuracy/latency of the projection stage for several k')
+    parser.add_argument('dirname', help='directory with opened/ and closed/ subdirectories')
+    parser.add_argument('--k', nargs='+', type=int, default=[16, 32, 64, 128, 256])
+    parser.add_argument('--kind', choices=PROJECTIONS[1:], default='pca')
+    parser.add_argument('--iterations', type=int, default=16)
+    parser.add_argument('--baseline', action='store_true', help='also train on the raw pixels')
+    parser.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX))
+    parser.add_argument('--roi_scale', type=int, default=1)
+    parser.add_argument('--decode', choices=ingest.DECODES, default='full',
+                           help='jpg decode the model was trained on')
+    parser.add_argument('--feature_cache', default=None,
+                        help='directory of decoded frames (see feature_cache.py), so pictures are decoded once')
+    args = parser.parse_args()
+
+    logging.setup(level='WARNING')
+    report(args.dirname, args.k, args.kind, args.iterations,
+           ingest.FrameSpec(args.roi, args.roi_scale, args.decode), args.baseline, args.feature_cache)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/bin/python
+"""
+Sparse weight mode for Predicter_NN.
+
+Most of the ~3.5M Theta1 weights are close to zero. prune() drops the
+small ones, either every weight below a threshold or all but the top-k of
+each hidden unit, and the rest is kept in compressed sparse row form
+(one row per hidden unit) so the hidden layer costs one multiply per kept
+weight instead of one per pixel.
+
+  python -m classifier.prune convert ThetasV7.mat ThetasV7.sparse.npz --keep 0.1
+  python -m classifier.prune report --day_model ThetasV7.mat \
+      --night_model NThetasV7.mat <labeled dir> --keep 0.5 0.2 0.1 0.05
+"""
+import common.log as logging
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+import numpy
+from scipy import sparse
+
+import nn_engine
+import weight_cache
+import evaluate
+from feature_cache import FeatureCache
+import ingest
+import model_file
+
+logger = logging.getLogger()
+
+# zero every weight of W (hidden x input) with |w| < threshold, or keep only
+# the keep largest |w| of each row. keep may be a count or a fraction of the
+# row (0 < keep < 1). returns a csr matrix
+def prune(W, threshold=None, keep=None):
+    W = numpy.asarray(W, dtype=numpy.float32)
+    if keep is not None:
+        k = int(round(keep * W.shape[1])) if keep < 1 else int(keep)
+        k = max(1, min(k, W.shape[1]))
+        # threshold of each row: the k-th largest magnitude
+        mag = numpy.abs(W)
+        cut = -numpy.partition(-mag, k - 1, axis=1)[:, k - 1]
+        mask = mag >= cut[:, numpy.newaxis]
+    elif threshold is not None:
+        mask = numpy.abs(W) >= threshold
+    else:
+        mask = W != 0
+    return sparse.csr_matrix(numpy.where(mask, W, numpy.float32(0)))
+
+class SparseNNEngine (object):
+    '''
+    SparseNNEngine - 3 layer network with a pruned hidden layer.
+
+    W1 is a hidden x input csr matrix (input in C order of the frame, like
+    NNEngine), bias1 the float32 bias of each hidden unit and W2 the float32
+    (hidden+1) x output matrix of NNEngine.
+    '''
+    def __init__(self, W1, bias1, W2, shape=nn_engine.FRAME_SHAPE):
+        self.W1 = W1
+        self.bias1 = bias1
+        self.W2 = W2
+        self.shape = shape
+        self.hidden_size, self.input_size = W1.shape
+        self.output_size = W2.shape[1]
+        self.nnz = W1.nnz
+        self.density = float(W1.nnz) / (self.hidden_size * self.input_size)
+        self.nbytes = W1.data.nbytes + W1.indices.nbytes + W1.indptr.nbytes + \
+                      bias1.nbytes + W2.nbytes
+        self.buffers = threading.local()
+
+    @classmethod
+    def from_engine(cls, engine, threshold=None, keep=None):
+        W1 = prune(engine.W1[1:].T, threshold, keep)
+        return cls(W1, numpy.array(engine.W1[0], dtype=numpy.float32), engine.W2, engine.shape)
+
+    @classmethod
+    def from_thetas(cls, Theta1, Theta2, shape=nn_engine.FRAME_SHAPE, threshold=None, keep=None):
+        return cls.from_engine(nn_engine.NNEngine.from_thetas(Theta1, Theta2, shape), threshold, keep)
+
+    def save(self, filename):
+        numpy.savez(filename, data=self.W1.data, indices=self.W1.indices, indptr=self.W1.indptr,
+                    W1_shape=numpy.array(self.W1.shape), bias1=self.bias1,
+                    W2=self.W2, shape=numpy.array(self.shape))
+
+    @classmethod
+    def load(cls, filename):
+        x = numpy.load(filename)
+        if 'indptr' not in x:
+            raise ValueError(filename + " is not a sparse model (see prune convert)")
+        W1 = sparse.csr_matrix((x['data'], x['indices'], x['indptr']), shape=tuple(x['W1_shape']))
+        return cls(W1, x['bias1'], x['W2'], tuple(x['shape']))
+
+    # arrays stored in a native model file (see model_file.py)
+    def arrays(self):
+        return {'data': self.W1.data, 'indices': self.W1.indices, 'indptr': self.W1.indptr,
+                'bias1': self.bias1, 'W2': self.W2}
+
+    @classmethod
+    def from_arrays(cls, arrays, shape=nn_engine.FRAME_SHAPE):
+        # plain ndarray views, so scipy keeps the memory mapped pages instead
+        # of copying the memmap subclass
+        data, indices, indptr = [numpy.asarray(arrays[name]) for name in ('data', 'indices', 'indptr')]
+        W1 = sparse.csr_matrix((data, indices, indptr),
+                               shape=(len(arrays['bias1']), shape[0] * shape[1]), copy=False)
+        return cls(W1, arrays['bias1'], arrays['W2'], shape)
+
+    def _get_buffers(self, m):
+        b = self.buffers
+        if getattr(b, 'size', 0) < m:
+            b.input = numpy.empty((m, self.input_size), dtype=numpy.float32)
+            b.hidden = numpy.empty((m, self.hidden_size), dtype=numpy.float32)
+            b.output = numpy.empty((m, self.output_size), dtype=numpy.float32)
+            b.size = m
+        return (b.input[:m], b.hidden[:m], b.output[:m])
+
+    # same contract as NNEngine.forward
+    def forward(self, frames):
+        m = len(frames)
+        X, hidden, output = self._get_buffers(m)
+        for row in range(m):
+            X[row] = numpy.ravel(frames[row])
+        # one sparse x dense product for the batch, over the kept weights only
+        hidden[...] = self.W1.dot(X.T).T
+        hidden += self.bias1
+        nn_engine.sigmoid_inplace(hidden)
+        numpy.dot(hidden, self.W2[1:], out=output)
+        output += self.W2[0]
+        nn_engine.sigmoid_inplace(output)
+        return output.astype(numpy.float64)
+
+# WeightCache loader for weight_mode=sparse. Takes a file written by
+# "prune convert" or a sparse native model. A mat or float32 native model
+# is loaded with only its exact zeros dropped
+def load_engine(filename, spec=ingest.DEFAULT_SPEC):
+    if model_file.is_model_file(filename):
+        header, arrays = model_file.load_checked(filename, spec)
+        if header['kind'] == 'sparse':
+            return SparseNNEngine.from_arrays(arrays, spec.shape)
+        if header['kind'] == 'float32':
+            return SparseNNEngine.from_engine(nn_engine.NNEngine.from_arrays(arrays, spec.shape))
+        raise ValueError("%s is a %s model, weight_mode sparse needs a sparse or float32 model" %
+                         (filename, header['kind']))
+    if filename.endswith('.npz'):
+        engine = SparseNNEngine.load(filename)
+        if engine.shape != spec.shape:
+            raise ValueError("%s was built for a %s frame, the roi gives %s" %
+                             (filename, str(engine.shape), str(spec.shape)))
+        return engine
+    logger.info("weight_mode sparse on a mat file, run prune convert to prune " + str(filename))
+    Theta1, Theta2 = weight_cache.load_thetas(filename)
+    return SparseNNEngine.from_thetas(Theta1, Theta2, spec.shape)
+
+def convert(mat_file, out_file, threshold=None, keep=None, spec=ingest.DEFAULT_SPEC):
+    Theta1, Theta2 = weight_cache.load_thetas(mat_file)
+    engine = SparseNNEngine.from_thetas(Theta1, Theta2, spec.shape, threshold, keep)
+    engine.save(out_file)
+    print "%s: kept %d of %d weights (%.1f%%), %d bytes" % \
+          (mat_file, engine.nnz, engine.hidden_size * engine.input_size,
+           engine.density * 100.0, engine.nbytes)
+
+# classify a labeled directory with the dense model and with the model
+# pruned at every level, printing sparsity, accuracy and latency of each
+def report(day_model, night_model, dirname, thresholds=(), keeps=(), spec=ingest.DEFAULT_SPEC,
+           feature_cache=None):
+    import predict_NN
+    files, labels = evaluate.labeled_files(dirname)
+    if len(files) == 0:
+        print "no labeled jpg files under " + dirname
+        return
+    cache = FeatureCache(feature_cache, spec) if feature_cache else None
+
+    # densities is (day, night)
+    def run(name, day, night, mode, densities):
+        predicter = predict_NN.Predicter_NN(day, night, weight_mode=mode, spec=spec,
+                                            cache_size=0, change_threshold=0)
+        result = evaluate.evaluate(predicter, files, labels, cache)
+        engine = predicter.day_weights.get()
+        frame = predicter.load_image(files[0])
+        start = time()
+        for i in range(20):
+            engine.forward([frame])
+        latency = (time() - start) / 20
+        print "%-16s %11.2f%% %12.2f%% %10.4f %14.2f %12.2f" % \
+              (name, densities[0] * 100.0, densities[1] * 100.0, result['accuracy'],
+               result['seconds_per_frame']*1000.0, latency*1000.0)
+        return result
+
+    print "%-16s %12s %13s %10s %14s %12s" % \
+          ('model', 'day density', 'night density', 'accuracy', 'batch ms/frame', '1 frame ms')
+    dense = run('dense', day_model, night_model, 'float32', (1.0, 1.0))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        levels = [('threshold', t) for t in thresholds] + [('keep', k) for k in keeps]
+        for kind, value in levels:
+            pruned = list()
+            for model in (day_model, night_model):
+                Theta1, Theta2 = weight_cache.load_thetas(model)
+                kwargs = {kind: value}
+                engine = SparseNNEngine.from_thetas(Theta1, Theta2, spec.shape, **kwargs)
+                out = os.path.join(tmpdir, "%d.npz" % len(pruned))
+                engine.save(out)
+                pruned.append((out, engine.density))
+            result = run("%s %g" % (kind, value), pruned[0][0], pruned[1][0], 'sparse',
+                         (pruned[0][1], pruned[1][1]))
+            flips = [1 for d, s in zip(dense['confidences'], result['confidences'])
+                     if d is not None and s is not None and (d >= 0.5) != (s >= 0.5)]
+            if len(flips) > 0:
+                print "%-16s %d labels flipped" % ('', len(flips))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    parser = argparse.ArgumentParser(description='sparse model tools for Predicter_NN')
+    commands = parser.add_subparsers(dest='command')
+    conv = commands.add_parser('convert', help='prune a Theta mat file')
+    conv.add_argument('mat_file')
+    conv.add_argument('out_file', help='output .npz file')
+    level = conv.add_mutually_exclusive_group(required=True)
+    level.add_argument('--threshold', type=float, help='drop weights with a magnitude below this')
+    level.add_argument('--keep', type=float, help='weights kept per hidden unit, a count or a fraction < 1')
+    rep = commands.add_parser('report', help='sparsity vs accuracy vs latency on a labeled directory')
+    rep.add_argument('--day_model', required=True)
+    rep.add_argument('--night_model', default=None, help='defaults to the day model')
+    rep.add_argument('--threshold', nargs='*', type=float, default=[])
+    rep.add_argument('--keep', nargs='*', type=float, default=[0.5, 0.2, 0.1, 0.05])
+    rep.add_argument('dirname', help='directory with opened/ and closed/ subdirectories')
+    for sub in (conv, rep):
+        sub.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX),
+                         help='roi the model was trained on: left upper right lower')
+        sub.add_argument('--roi_scale', type=int, default=1)
+        sub.add_argument('--decode', choices=ingest.DECODES, default='full',
+                            help='jpg decode the model was trained on')
+    rep.add_argument('--feature_cache', default=None,
+                     help='directory of decoded frames (see feature_cache.py), so pictures are decoded once')
+    args = parser.parse_args()
+
+    logging.setup(level='WARNING')
+    spec = ingest.FrameSpec(args.roi, args.roi_scale, args.decode)
+    if args.command == 'convert':
+        convert(args.mat_file, args.out_file, args.threshold, args.keep, spec)
+    else:
+        report(args.day_model, args.night_model or args.day_model, args.dirname,
+               args.threshold, args.keep, spec, args.feature_cache)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/bin/python
+"""
+Int8 weight mode for Predicter_NN.
+
+Theta1 is kept as int8 with one float32 scale per hidden unit (row), which
+cuts it from ~28MB (float64) to ~3.5MB per model. Frames are fed as uint8
+shifted by 128; the shift is added back through a precomputed per row
+offset. numpy has no BLAS kernel for integer matrices, so forward() widens
+BLOCK_SIZE columns of the int8 weights at a time into a float32 scratch
+block and runs one sgemm per block; only the int8 weights stay resident.
+
+  python -m classifier.quantize convert ThetasV7.mat ThetasV7.npz
+  python -m classifier.quantize report --day_model ThetasV7.mat \
+      --night_model NThetasV7.mat <labeled dir>
+"""
+import common.log as logging
+import argparse
+import threading
+import numpy
+
+import nn_engine
+import weight_cache
+import evaluate
+from feature_cache import FeatureCache
+import ingest
+import model_file
+
+logger = logging.getLogger()
+
+# columns of W1q widened to float32 at a time by forward()
+BLOCK_SIZE = 4096
+# uint8 frames are centered on this value before the integer matmul
+ZERO_POINT = 128
+
+class QuantizedNNEngine (object):
+    '''
+    QuantizedNNEngine - 3 layer network with an int8 hidden layer.
+
+    W1q is hidden x input int8 (input in C order of the frame, like NNEngine),
+    scale1 the per row scale and bias1 the float32 bias of each hidden unit.
+    W2 is the float32 (hidden+1) x output matrix of NNEngine. nbytes counts
+    the arrays kept for the model plus one float32 scratch block of
+    forward(); the per batch buffers come on top.
+    '''
+    def __init__(self, W1q, scale1, bias1, W2, shape=nn_engine.FRAME_SHAPE):
+        self.W1q = W1q
+        self.scale1 = scale1
+        self.bias1 = bias1
+        self.W2 = W2
+        self.shape = shape
+        self.hidden_size, self.input_size = W1q.shape
+        self.output_size = W2.shape[1]
+        # z = scale * sum(w*(x-128)) + (bias + scale * 128 * sum(w))
+        self.offset1 = (bias1 + scale1 * ZERO_POINT *
+                        W1q.sum(axis=1, dtype=numpy.int64)).astype(numpy.float32)
+        self.block_size = min(BLOCK_SIZE, self.input_size)
+        self.nbytes = W1q.nbytes + scale1.nbytes + bias1.nbytes + W2.nbytes + \
+                      self.offset1.nbytes + self.block_size * self.hidden_size * 4
+        self.buffers = threading.local()
+
+    @classmethod
+    def from_engine(cls, engine):
+        W = engine.W1[1:].T
+        scale1 = numpy.abs(W).max(axis=1) / 127.0
+        scale1[scale1 == 0] = 1.0
+        W1q = numpy.rint(W / scale1[:, numpy.newaxis]).astype(numpy.int8)
+        return cls(W1q, scale1.astype(numpy.float32),
+                   numpy.array(engine.W1[0], dtype=numpy.float32),
+                   engine.W2, engine.shape)
+
+    @classmethod
+    def from_thetas(cls, Theta1, Theta2, shape=nn_engine.FRAME_SHAPE):
+        return cls.from_engine(nn_engine.NNEngine.from_thetas(Theta1, Theta2, shape))
+
+    def save(self, filename):
+        numpy.savez(filename, W1q=self.W1q, scale1=self.scale1, bias1=self.bias1,
+                    W2=self.W2, shape=numpy.array(self.shape))
+
+    @classmethod
+    def load(cls, filename):
+        x = numpy.load(filename)
+        return cls(x['W1q'], x['scale1'], x['bias1'], x['W2'], tuple(x['shape']))
+
+    # arrays stored in a native model file (see model_file.py)
+    def arrays(self):
+        return {'W1q': self.W1q, 'scale1': self.scale1, 'bias1': self.bias1, 'W2': self.W2}
+
+    @classmethod
+    def from_arrays(cls, arrays, shape=nn_engine.FRAME_SHAPE):
+        return cls(arrays['W1q'], arrays['scale1'], arrays['bias1'], arrays['W2'], shape)
+
+    def _get_buffers(self, m):
+        b = self.buffers
+        if getattr(b, 'size', 0) < m:
+            b.input = numpy.empty((m, self.input_size), dtype=numpy.float32)
+            b.acc = numpy.empty((m, self.hidden_size), dtype=numpy.float32)
+            b.partial = numpy.empty((m, self.hidden_size), dtype=numpy.float32)
+            b.hidden = numpy.empty((m, self.hidden_size), dtype=numpy.float32)
+            b.output = numpy.empty((m, self.output_size), dtype=numpy.float32)
+            b.size = m
+        if getattr(b, 'block', None) is None:
+            b.block = numpy.empty((self.block_size, self.hidden_size), dtype=numpy.float32)
+        return (b.input[:m], b.acc[:m], b.partial[:m], b.hidden[:m], b.output[:m], b.block)
+
+    # same contract as NNEngine.forward. frames that are not uint8 (e.g. the
+    # histogram equalized night frames) are rounded to the 0-255 range
+    def forward(self, frames):
+        m = len(frames)
+        X, acc, partial, hidden, output, block = self._get_buffers(m)
+        for row in range(m):
+            frame = numpy.ravel(frames[row])
+            if frame.dtype != numpy.uint8:
+                frame = numpy.clip(numpy.rint(frame), 0, 255)
+            X[row] = frame
+        X -= ZERO_POINT
+
+        # products of 8 bit values are exact in float32 and their sums only
+        # round past 2**24, far below the quantization error
+        acc[:] = 0
+        for start in range(0, self.input_size, self.block_size):
+            end = min(start + self.block_size, self.input_size)
+            W = block[:end-start]
+            W[:] = self.W1q[:, start:end].T
+            numpy.dot(X[:, start:end], W, out=partial)
+            acc += partial
+        numpy.multiply(acc, self.scale1, out=hidden)
+        hidden += self.offset1
+        nn_engine.sigmoid_inplace(hidden)
+        numpy.dot(hidden, self.W2[1:], out=output)
+        output += self.W2[0]
+        nn_engine.sigmoid_inplace(output)
+        return output.astype(numpy.float64)
+
+# WeightCache loader for weight_mode=int8. Takes a file written by
+# "quantize convert", an int8 or float32 native model, or quantizes a mat
+# file while loading it
+def load_engine(filename, spec=ingest.DEFAULT_SPEC):
+    if model_file.is_model_file(filename):
+        header, arrays = model_file.load_checked(filename, spec)
+        if header['kind'] == 'int8':
+            return QuantizedNNEngine.from_arrays(arrays, spec.shape)
+        if header['kind'] == 'float32':
+            return QuantizedNNEngine.from_engine(nn_engine.NNEngine.from_arrays(arrays, spec.shape))
+        raise ValueError("%s is a %s model, weight_mode int8 needs an int8 or float32 model" %
+                         (filename, header['kind']))
+    if filename.endswith('.npz'):
+        engine = QuantizedNNEngine.load(filename)
+        if engine.shape != spec.shape:
+            raise ValueError("%s was built for a %s frame, the roi gives %s" %
+                             (filename, str(engine.shape), str(spec.shape)))
+        return engine
+    Theta1, Theta2 = weight_cache.load_thetas(filename)
+    return QuantizedNNEngine.from_thetas(Theta1, Theta2, spec.shape)
+
+def convert(mat_file, out_file, spec=ingest.DEFAULT_SPEC):
+    Theta1, Theta2 = weight_cache.load_thetas(mat_file)
+    engine = QuantizedNNEngine.from_thetas(Theta1, Theta2, spec.shape)
+    engine.save(out_file)
+    print "%s: Theta1 %s float64 %d bytes -> int8 %d bytes" % \
+          (mat_file, str(Theta1.shape), Theta1.nbytes, engine.nbytes)
+
+# classify a labeled directory with the float and the int8 model and print
+# the accuracy of each plus how far the confidences moved
+def report(day_model, night_model, dirname, spec=ingest.DEFAULT_SPEC, feature_cache=None):
+    import predict_NN
+    files, labels = evaluate.labeled_files(dirname)
+    if len(files) == 0:
+        print "no labeled jpg files under " + dirname
+        return
+    cache = FeatureCache(feature_cache, spec) if feature_cache else None
+
+    results = dict()
+    for mode in ('float32', 'int8'):
+        predicter = predict_NN.Predicter_NN(day_model, night_model, weight_mode=mode, spec=spec)
+        results[mode] = evaluate.evaluate(predicter, files, labels, cache)
+        print "%-8s accuracy %.4f  %.2f ms/frame  (%d frames)" % \
+              (mode, results[mode]['accuracy'],
+               results[mode]['seconds_per_frame']*1000.0, results[mode]['frames'])
+
+    deltas = [abs(f - q) for f, q in zip(results['float32']['confidences'], results['int8']['confidences'])
+              if f is not None and q is not None]
+    flips = [1 for f, q in zip(results['float32']['confidences'], results['int8']['confidences'])
+             if f is not None and q is not None and (f >= 0.5) != (q >= 0.5)]
+    print "accuracy delta %+.4f" % (results['int8']['accuracy'] - results['float32']['accuracy'])
+    if len(deltas) > 0:
+        print "confidence delta mean %.6f max %.6f, %d of %d labels flipped" % \
+              (sum(deltas) / len(deltas), max(deltas), len(flips), len(deltas))
+
+def main():
+    parser = argparse.ArgumentParser(description='int8 model tools for Predicter_NN')
+    commands = parser.add_subparsers(dest='command')
+    conv = commands.add_parser('convert', help='quantize a Theta mat file')
+    conv.add_argument('mat_file')
+    conv.add_argument('out_file', help='output .npz file')
+    rep = commands.add_parser('report', help='accuracy of int8 vs float model on a labeled directory')
+    rep.add_argument('--day_model', required=True)
+    rep.add_argument('--night_model', default=None, help='defaults to the day model')
+    rep.add_argument('dirname', help='directory with opened/ and closed/ subdirectories')
+    for sub in (conv, rep):
+        sub.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX),
+                         help='roi the model was trained on: left upper right lower')
+        sub.add_argument('--roi_scale', type=int, default=1)
+        sub.add_argument('--decode', choices=ingest.DECODES, default='full',
+                            help='jpg decode the model was trained on')
+    rep.add_argument('--feature_cache', default=None,
+                     help='directory of decoded frames (see feature_cache.py), so pictures are decoded once')
+    args = parser.parse_args()
+
+    logging.setup(level='WARNING')
+    spec = ingest.FrameSpec(args.roi, args.roi_scale, args.decode)
+    if args.command == 'convert':
+        convert(args.mat_file, args.out_file, spec)
+    else:
+        report(args.day_model, args.night_model or args.day_model, args.dirname, spec, args.feature_cache)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import common.log as logging
+import os
+import hashlib
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+from time import time as now
+
+logger = logging.getLogger()
+
+# bumped when the layout of the persistence file changes
+FORMAT_VERSION = 1
+# bytes read at a time when hashing a picture
+HASH_BLOCK = 65536
+
+# sha1 of the file content
+def content_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+class ResultCache (object):
+    '''
+    ResultCache - bounded LRU of prediction results.
+
+    Results are keyed by the content hash of the picture plus the version of
+    the model that produced them, so a copied or renamed picture still hits
+    and a retrained model never gets an old answer. Hashing a file is much
+    cheaper than decoding it, and the (device, inode, mtime, size) of a file
+    already hashed is remembered so an unchanged file is not even read.
+
+    If filename is given the cache is loaded from it on creation and written
+    back (atomically) at most every save_interval seconds when it changed,
+    and on save().
+    '''
+    def __init__(self, capacity=1024, filename=None, save_interval=60):
+        self.capacity = capacity
+        self.filename = filename
+        self.save_interval = save_interval
+        self.results = OrderedDict()
+        self.hashes = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stat_hits = 0
+        self.dirty = False
+        self.last_save = now()
+        if filename is not None:
+            self.load()
+
+    def _stat_key(self, filename):
+        st = os.stat(filename)
+        return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+    # content hash of filename, from the stat index when the file is unchanged
+    def hash(self, filename):
+        stat_key = self._stat_key(filename)
+        with self.lock:
+            digest = self.hashes.pop(stat_key, None)
+            if digest is not None:
+                self.hashes[stat_key] = digest
+                self.stat_hits += 1
+                return digest
+        digest = content_hash(filename)
+        with self.lock:
+            self.hashes[stat_key] = digest
+            while len(self.hashes) > self.capacity:
+                self.hashes.popitem(last=False)
+        return digest
+
+    # cache key of filename for a model version. raises IOError/OSError if
+    # the file cannot be read
+    def key(self, filename, version):
+        return (self.hash(filename), version)
+
+    # cached result for key or None. counts a hit or a miss
+    def get(self, key):
+        with self.lock:
+            result = self.results.pop(key, None)
+            if result is None:
+                self.misses += 1
+                return None
+            self.results[key] = result
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = result
+            while len(self.results) > self.capacity:
+                self.results.popitem(last=False)
+            self.dirty = True
+        if self.filename is not None and now() - self.last_save >= self.save_interval:
+            self.save()
+
+    # counters for monitoring
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'stat_hits': self.stat_hits,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                    'entries': len(self.results),
+                    'capacity': self.capacity}
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.hashes.clear()
+            self.dirty = True
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return False
+        try:
+            with open(self.filename, 'rb') as f:
+                state = pickle.load(f)
+            if state.get('format') != FORMAT_VERSION:
+                logger.warning("Ignoring result cache with an unknown format: " + self.filename)
+                return False
+        except Exception as ex:
+            logger.error("Load result cache failed: " + self.filename)
+            logger.debug(ex)
+            return False
+        with self.lock:
+            self.results = OrderedDict(state['results'][-self.capacity:])
+            self.hashes = OrderedDict(state['hashes'][-self.capacity:])
+            self.dirty = False
+        logger.info("Loaded %d cached results from %s" % (len(self.results), self.filename))
+        return True
+
+    # write the cache to filename through a temporary file so a crash never
+    # leaves a truncated cache behind
+    def save(self):
+        if self.filename is None:
+            return False
+        with self.lock:
+            if not self.dirty:
+                return False
+            state = {'format': FORMAT_VERSION,
+                     'results': self.results.items(),
+                     'hashes': self.hashes.items()}
+            self.dirty = False
+            self.last_save = now()
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError) as ex:
+            logger.error("Save result cache failed: " + self.filename)
+            logger.debug(ex)
+            with self.lock:
+                self.dirty = True
+            return False
+        return True
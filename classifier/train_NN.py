@@ -1,9 +1,20 @@
 import common.log as logging
 import common.config as Conf
 import os, sys, signal, errno
+import argparse
+import tempfile
 import predict
-
-from time import localtime
+import ingest
+from projection import Projection, PROJECTIONS
+import model_file
+import nn_engine
+import dataset
+import minibatch
+import incremental
+import weight_cache
+from feature_cache import FeatureCache
+
+from time import localtime, time as time_now
 from datetime import datetime, date, timedelta, time
 from re import search
 
@@ -14,7 +25,6 @@ from scipy import io
 from shutil import move
 import numpy
 from scipy import optimize
-import Image
 import sys
 import errno
 from service import service
@@ -30,18 +40,104 @@ Options = [
                  group   = 'trainer.Train_NN',
                  default = '$HOME/.garageeye/data',
                  help    = 'absolute path to image path'),
+    Conf.ListOpt(name    = 'roi',
+                 group   = 'trainer.Train_NN',
+                 default = list(ingest.CROP_BOX),
+                 help    = 'region of interest fed to the network: left upper right lower, in 320x240 picture coordinates'),
+    Conf.IntOpt(name    = 'roi_scale',
+                group   = 'trainer.Train_NN',
+                default = 1,
+                help    = 'integer downscale factor applied to the region of interest'),
+    Conf.StrOpt(name    = 'decode',
+                group   = 'trainer.Train_NN',
+                default = 'full',
+                help    = 'jpg decode: full (what the models were trained on) or draft (decodes at the reduced scale, several times faster, needs a model trained with it)'),
+    Conf.FileOpt(name    = 'mat_file',
+                 group   = 'trainer.Train_NN',
+                 default = None,
+                 help    = 'mat file the trained Thetas are written to (not saved if unset). a name ending in .model writes a native model file'),
+    Conf.StrOpt(name    = 'projection',
+                group   = 'trainer.Train_NN',
+                default = 'none',
+                help    = 'feature reduction ahead of the hidden layer. options are: none, pca, random'),
+    Conf.IntOpt(name    = 'projection_k',
+                group   = 'trainer.Train_NN',
+                default = 200,
+                help    = 'number of features kept by the projection'),
+    Conf.IntOpt(name    = 'projection_seed',
+                group   = 'trainer.Train_NN',
+                default = 0,
+                help    = 'seed of the random projection'),
+    Conf.DirOpt (name    = 'feature_cache',
+                 group   = 'trainer.Train_NN',
+                 default = '$HOME/.garageeye/features',
+                 help    = 'directory the decoded training frames are kept in, so a picture is only decoded again when it changes. empty to decode every run'),
+    Conf.IntOpt(name    = 'chunk_size',
+                group   = 'trainer.Train_NN',
+                default = 0,
+                help    = 'train out of core: the training set is kept in a uint8 file and this many pictures are in memory at a time. 0 loads the whole set in memory'),
+    Conf.StrOpt(name    = 'optimizer',
+                group   = 'trainer.Train_NN',
+                default = 'CG',
+                help    = 'how the weights are fit. options are: CG, L-BFGS-B (scipy.optimize.minimize on the whole set), sgd, momentum, adam (mini-batches)'),
+    Conf.IntOpt(name    = 'epochs',
+                group   = 'trainer.Train_NN',
+                default = 10,
+                help    = 'passes over the training set of the mini-batch optimizers'),
+    Conf.IntOpt(name    = 'batch_size',
+                group   = 'trainer.Train_NN',
+                default = 64,
+                help    = 'pictures per mini-batch'),
+    Conf.FloatOpt(name    = 'learning_rate',
+                  group   = 'trainer.Train_NN',
+                  default = 0.001,
+                  help    = 'step size of the mini-batch optimizers (the first epoch for a schedule)'),
+    Conf.StrOpt(name    = 'lr_schedule',
+                group   = 'trainer.Train_NN',
+                default = 'constant',
+                help    = 'learning rate over the epochs. options are: constant, step, exponential, cosine'),
+    Conf.FloatOpt(name    = 'lr_decay',
+                  group   = 'trainer.Train_NN',
+                  default = 0.5,
+                  help    = 'factor the learning rate is multiplied by at every step (step, exponential schedules)'),
+    Conf.IntOpt(name    = 'lr_step',
+                group   = 'trainer.Train_NN',
+                default = 10,
+                help    = 'epochs between the steps of the step schedule'),
+    Conf.FloatOpt(name    = 'momentum',
+                  group   = 'trainer.Train_NN',
+                  default = 0.9,
+                  help    = 'momentum of the momentum optimizer'),
+    Conf.FileOpt(name    = 'warm_start',
+                 group   = 'trainer.Train_NN',
+                 default = None,
+                 help    = 'model file or models directory to fine-tune instead of training from random weights. only the pictures not in seen_ledger and a replayed sample of the others are trained on'),
+    Conf.FloatOpt(name    = 'replay_ratio',
+                  group   = 'trainer.Train_NN',
+                  default = 4.0,
+                  help    = 'pictures trained on before that are replayed per new picture when fine-tuning'),
+    Conf.FileOpt(name    = 'seen_ledger',
+                 group   = 'trainer.Train_NN',
+                 default = '$HOME/.garageeye/seen.ledger',
+                 help    = 'file recording the pictures the model was trained on, so fine-tuning only trains on the new ones'),
 ]
 
+# minimize methods that take the fused cost and gradient (jac=True)
+OPTIMIZERS = ('CG', 'L-BFGS-B')
+
 logger = logging.getLogger()
 CONF = Conf.Config
 CONF.registerOpt(Options)
 
-input_layer_size = 320*220
+# the input layer size comes from the roi (ingest.FrameSpec.size)
 hidden_layer_size = 50
 output_layer_size  = 1
 
 max_iterations = 16
 
+# scale of the inputs the mini-batch optimizers step on (see fit_minibatch)
+minibatch_input_scale = 1.0 / 255.0
+
 def sigmoid (x):
     y = 1.0 / (1.0 + numpy.exp(-1.0*x))
     return y
@@ -61,15 +157,16 @@ def add_bias_term (x, size, ax=1):
 
 def nnFeedForward (initial_theta, *args):
     inputX, Y = args
+    input_layer_size = inputX.shape[1]
     border = hidden_layer_size*(input_layer_size+1)
-    Theta1 = numpy.reshape(initial_theta[0:border], (hidden_layer_size, input_layer_size+1),order='F')
-    Theta2 = numpy.reshape(initial_theta[border:], (output_layer_size, hidden_layer_size+1),order='F')
+    Theta1 = numpy.matrix(numpy.reshape(initial_theta[0:border], (hidden_layer_size, input_layer_size+1),order='F'))
+    Theta2 = numpy.matrix(numpy.reshape(initial_theta[border:], (output_layer_size, hidden_layer_size+1),order='F'))
     m = inputX.shape[0]
     #feed forward network
 
-    # input layer
-    inputX = add_bias_term(inputX, m)
-    z2 = Theta1*inputX.T
+    # input layer. the bias column of Theta1 is added to the product instead
+    # of copying inputX with a column of ones in front
+    z2 = Theta1[:, 1:]*inputX.T + Theta1[:, 0]
     a2 = sigmoid(z2)
     a2 = add_bias_term(a2, a2.shape[1], ax=0)
 
@@ -85,8 +182,41 @@ def nnFeedForward (initial_theta, *args):
     J = J / m
     return (J, z3, a3, z2, a2)
 
+# cost J and its gradient from one forward and one backward pass
+def nnCostGradFunction (initial_theta, *args):
+    inputX, Y = args
+    input_layer_size = inputX.shape[1]
+    border = hidden_layer_size*(input_layer_size+1)
+    Theta2 = numpy.matrix(numpy.reshape(initial_theta[border:], (output_layer_size, hidden_layer_size+1),order='F'))
+    J, z3, a3, z2, a2 = nnFeedForward(initial_theta, *args)
+    # use backpropagation algorithm to compute del(J) [gradient Cost]
+    # over all the samples at once: one matrix product per layer
+
+    # m = samples
+    m = inputX.shape[0]
+
+    # output layer error, m x 1
+    delta3 = a3 - Y
+    # hidden layer error, hidden x m. a2 holds sigmoid(z2) below its bias row
+    delta2 = numpy.multiply(Theta2[:, 1:].T*delta3.T, numpy.multiply(a2[1:], 1.0-a2[1:]))
+
+    Del2 = delta3.T*a2.T
+    # the bias column of Del1 is the sum of the errors, the rest one product
+    # with the (unbiased) input
+    Del1 = numpy.concatenate((delta2.sum(axis=1), delta2*inputX), axis=1)
+
+    # no lambda tern for now. This means no regularization
+    gradTheta2 = Del2 / m
+    gradTheta1 = Del1 / m
+    return (float(J), (numpy.concatenate(((gradTheta1.T).ravel(), (gradTheta2.T).ravel()), axis=1).T).A1)
+
 def nnGradCostFunction (initial_theta, *args):
+    return nnCostGradFunction(initial_theta, *args)[1]
+
+# the per sample loop nnGradCostFunction replaced. kept for benchmark()
+def _nnGradCostFunctionLoop (initial_theta, *args):
     inputX, Y = args
+    input_layer_size = inputX.shape[1]
     border = hidden_layer_size*(input_layer_size+1)
     Theta1 = numpy.reshape(initial_theta[0:border], (hidden_layer_size, input_layer_size+1), order='F')
     Theta2 = numpy.reshape(initial_theta[border:], (output_layer_size, hidden_layer_size+1),order='F')
@@ -124,14 +254,105 @@ def nnCostFunction (initial_theta, *args):
     J, z3, a3, z2, a2 = nnFeedForward(initial_theta, *args)
     return J.A1
 
+class CostGrad (object):
+    '''
+    CostGrad - the training objective with its last result remembered.
+
+    Calling it returns (J, gradient) of nnCostGradFunction, the form
+    scipy.optimize.minimize takes with jac=True. The theta and result of the
+    last call are kept, so asking again for the same theta (the cost logged
+    by the iteration callback, or cost() and grad() called one after the
+    other by an optimizer that wants them apart) runs no extra pass.
+    '''
+    def __init__(self, inputX, Y):
+        self.args = (inputX, Y)
+        self.theta = None
+        self.result = None
+        self.evaluations = 0
+        self.hits = 0
+
+    def __call__(self, theta):
+        if self.theta is not None and numpy.array_equal(theta, self.theta):
+            self.hits += 1
+            return self.result
+        self.result = self.compute(theta)
+        self.theta = numpy.array(theta, copy=True)
+        self.evaluations += 1
+        return self.result
+
+    def compute(self, theta):
+        return nnCostGradFunction(theta, *self.args)
+
+    def cost(self, theta):
+        return self(theta)[0]
+
+    def grad(self, theta):
+        return self(theta)[1]
+
+class ChunkedCostGrad (CostGrad):
+    '''
+    ChunkedCostGrad - CostGrad over a dataset.ChunkedDataset.
+
+    J and the gradient are means over the samples, so the ones of every
+    chunk are added up weighted by the chunk's share of the samples. Only
+    one chunk of the input is in memory at a time.
+    '''
+    def compute(self, theta):
+        data, Y = self.args
+        m = data.shape[0]
+        J = 0.0
+        grad = numpy.zeros(len(theta))
+        for first, X in data.chunks():
+            Jc, gc = nnCostGradFunction(theta, X, Y[first:first+X.shape[0]])
+            weight = float(X.shape[0]) / m
+            J += Jc * weight
+            grad += gc * weight
+        return (J, grad)
+
 # class that runs a Neural Network
 class Train_NN (service.Service):
 
-    def __init__(self, path, periodic_enable=None, periodic_interval_max=None, *args, **kwargs):
+    def __init__(self, path, periodic_enable=None, periodic_interval_max=None,
+                 spec=ingest.DEFAULT_SPEC, mat_file=None, projection='none',
+                 projection_k=200, projection_seed=0, optimizer='CG', feature_cache=None,
+                 chunk_size=0, epochs=10, batch_size=64, learning_rate=0.001,
+                 lr_schedule='constant', lr_decay=0.5, lr_step=10, momentum=0.9,
+                 warm_start=None, replay_ratio=4.0, seen_ledger=None, *args, **kwargs):
         super(Train_NN, self).__init__()
         self.img_path = path
+        self.spec = spec
+        self.mat_file = mat_file
+        if projection not in PROJECTIONS:
+            raise ValueError("Unknown projection " + str(projection))
+        self.projection = projection
+        self.projection_k = projection_k
+        self.projection_seed = projection_seed
+        if optimizer not in OPTIMIZERS and optimizer not in minibatch.OPTIMIZERS:
+            raise ValueError("Unknown optimizer " + str(optimizer))
+        if lr_schedule not in minibatch.SCHEDULES:
+            raise ValueError("Unknown learning rate schedule " + str(lr_schedule))
+        self.optimizer = optimizer
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.lr_schedule = lr_schedule
+        self.lr_decay = lr_decay
+        self.lr_step = lr_step
+        self.momentum = momentum
+        self.feature_cache = feature_cache or None
+        if chunk_size > 0 and projection != 'none':
+            raise ValueError("a projection needs the whole training set in memory, set chunk_size to 0")
+        self.chunk_size = chunk_size
+        if warm_start and projection != 'none':
+            raise ValueError("fine-tuning trains on the pixels the model takes, set projection to none")
+        if warm_start and not seen_ledger:
+            raise ValueError("fine-tuning needs a seen_ledger")
+        self.warm_start = warm_start or None
+        self.replay_ratio = replay_ratio
+        self.seen_ledger = seen_ledger
         logger.debug("Img_path = " + str(self.img_path))
         self.args = None
+        self.objective = None
         self.iterCount = 1
         self.periodic_enable = periodic_enable
         self.periodic_interval_max = periodic_interval_max
@@ -169,10 +390,13 @@ class Train_NN (service.Service):
         :param periodic_interval_max: if set, the max time to wait between runs
 
         """
-        img_path = CONF.importOpt(module='classifier.train_NN', name='path', group='trainer.Train_NN')
-        service_obj = cls(img_path,
+        conf_vars = dict()
+        for name in CONF.get_opt_list('trainer.Train_NN'):
+            conf_vars[name] = CONF.importOpt(module='classifier.train_NN', name=name, group='trainer.Train_NN')
+        service_obj = cls(conf_vars['path'],
                           periodic_enable=periodic_enable,
-                          periodic_interval_max=periodic_interval_max
+                          periodic_interval_max=periodic_interval_max,
+                          **Train_NN.conf_kwargs(conf_vars)
                           )
 
         return service_obj
@@ -205,14 +429,14 @@ class Train_NN (service.Service):
             if search(r"(.+)\.jpg", file) is not None:
                 files_list.append(os.path.join(opened_path,file))
                 results_list.append(0)
-        self.train(files_list, results_list)
+        if self.warm_start is not None:
+            self.train_incremental(files_list, results_list)
+        else:
+            self.train(files_list, results_list)
 
     # load jpeg image and convert to greyscale
     def load_image (self, filename):
-        im = Image.open(filename).convert("L")
-        im = im.resize( (320, 240) )
-        im = im.crop( (0,0, 320, 220) )
-        return im
+        return ingest.load_frame(filename, spec=self.spec)
 
     # create a matrix with random values of the size input_layer_size by output_layer_size
     def randInitializeWeights (self,in_size, out_size):
@@ -230,60 +454,317 @@ class Train_NN (service.Service):
         h2 = sigmoid(numpy.dot (numpy.hstack((onesMat, h1)), Theta2.T))
         return h2
 
+    # unroll Theta1/Theta2 as the optimizer wants them
+    def unroll (self, Theta1, Theta2):
+        return numpy.concatenate((numpy.ravel(Theta1, order='F'), numpy.ravel(Theta2, order='F')))
+
+    # roll the optimizer parameter vector back into Theta1/Theta2
+    def roll (self, thetas, input_layer_size):
+        border = hidden_layer_size*(input_layer_size+1)
+        Theta1 = numpy.reshape(thetas[0:border], (hidden_layer_size, input_layer_size+1), order='F')
+        Theta2 = numpy.reshape(thetas[border:], (output_layer_size, hidden_layer_size+1), order='F')
+        return (Theta1, Theta2)
+
     def callbackIterationDone (self, xk):
-        x,y = self.args
-        J = nnCostFunction(xk, x,y)
+        # usually the point the optimizer evaluated last, so J is remembered
+        J = self.objective.cost(xk)
         logger.debug("Iteration completed [" + str(self.iterCount) + "] cost J = " + str(J))
         self.iterCount = self.iterCount + 1
 
     # Input a list of images, list of their states [closed/open]
-    # note, image size is 320*220
-    def train (self, image_files, results):
+    # note, image size is self.spec.shape (320*220 without a roi)
+    # initial is the (Theta1, Theta2) to start from instead of random
+    # weights, meta more training metadata to save with the model
+    def train (self, image_files, results, initial=None, meta=None):
         logger.info("training - BEGIN")
         # image_files is filenames of images
         # results is 1 and 0s
-        imageArr = list()
-        imageMatrix = None
-        resultsMatrix=None
-
-        # extract the files and create a matrix where
-        # each row belongs to the image (e.g. jpg)
-        # and the elements (cols) are the image data
-        for filename in image_files:
-            imageX = numpy.matrix(self.load_image(filename), dtype=numpy.float64)
-            imageX = imageX.flatten('F')
-            if imageMatrix is None:
-                imageMatrix = numpy.matrix(imageX, dtype=numpy.float64)
-            else:
-                imageMatrix = numpy.concatenate((imageMatrix, imageX))
+
+        # one matrix where each row belongs to the image (e.g. jpg)
+        # and the elements (cols) are the image data. The rows are filled
+        # in place, the matrix is allocated once
+        cache = None
+        if self.feature_cache is not None:
+            cache = FeatureCache(self.feature_cache, self.spec)
         resultsMatrix = numpy.matrix(results, dtype=numpy.float64).T
+        if self.chunk_size > 0:
+            return self.train_chunked(image_files, resultsMatrix, cache, initial, meta)
+        imageMatrix = numpy.asmatrix(dataset.load_dataset(image_files, self.spec, cache=cache))
+        if cache is not None:
+            logger.debug("feature cache: " + str(cache.stats()))
+
 
 
+        # optional feature reduction ahead of the hidden layer
+        proj = None
+        if self.projection != 'none':
+            proj = Projection.fit(self.projection, imageMatrix, self.projection_k, self.projection_seed)
+            imageMatrix = numpy.matrix(proj.apply(imageMatrix))
+            logger.debug("Projected input with " + self.projection + " to " + str(proj.k) + " features")
 
         # print out debug data
         logger.debug("Input Matrix dimension: " + str(imageMatrix.shape))
         logger.debug("Results Matrix dimension: " + str(resultsMatrix.shape))
-        Theta1 = self.randInitializeWeights (input_layer_size, hidden_layer_size).T
-        Theta2 = self.randInitializeWeights (hidden_layer_size, output_layer_size).T
+        _Theta1_, _Theta2_ = self.fit(imageMatrix, resultsMatrix, initial=initial)
+        y = self.predict(_Theta1_, _Theta2_, imageMatrix)
+        accuracy = numpy.mean((y>0.5)==resultsMatrix)
+        logger.debug("Accuracy is about " + str(accuracy))
+        meta = dict(meta or dict())
+        meta.update({'samples': imageMatrix.shape[0],
+                     'iterations': self.iterCount - 1,
+                     'optimizer': self.optimizer,
+                     'accuracy': float(accuracy),
+                     'projection': proj.kind if proj is not None else 'none'})
+        self.save(_Theta1_, _Theta2_, proj, meta)
+        logger.info("Training NN completed")
+        return (_Theta1_, _Theta2_, proj)
+
+    # train with the pictures in a uint8 file read chunk_size rows at a
+    # time (next to the feature cache if there is one), so memory doesn't
+    # grow with the number of pictures
+    def train_chunked (self, image_files, resultsMatrix, cache=None, initial=None, meta=None):
+        fd, filename = tempfile.mkstemp(suffix='.u8', prefix='trainset-', dir=self.feature_cache)
+        os.close(fd)
+        try:
+            data = dataset.ChunkedDataset.build(image_files, filename, self.spec,
+                                                chunk_size=self.chunk_size, cache=cache)
+            logger.debug("Input dataset dimension: %s in chunks of %d" % (str(data.shape), self.chunk_size))
+            _Theta1_, _Theta2_ = self.fit(data, resultsMatrix, initial=initial)
+            correct = 0
+            for first, X in data.chunks():
+                y = self.predict(_Theta1_, _Theta2_, X)
+                correct += numpy.sum((y>0.5)==resultsMatrix[first:first+X.shape[0]])
+            accuracy = float(correct) / data.shape[0]
+        finally:
+            os.remove(filename)
+        logger.debug("Accuracy is about " + str(accuracy))
+        meta = dict(meta or dict())
+        meta.update({'samples': data.shape[0],
+                     'iterations': self.iterCount - 1,
+                     'optimizer': self.optimizer,
+                     'accuracy': accuracy,
+                     'projection': 'none',
+                     'chunk_size': self.chunk_size})
+        self.save(_Theta1_, _Theta2_, None, meta)
+        logger.info("Training NN completed")
+        return (_Theta1_, _Theta2_, None)
+
+    # fine-tune the warm_start model with the pictures seen_ledger has not
+    # recorded (new, changed or relabeled) and replay_ratio times as many of
+    # the recorded ones, then record them. Without a model to start from
+    # every picture is trained on from random weights. A ledger written for
+    # another model than the warm start one (replaced, retrained or rolled
+    # back) is dropped. returns what train does, or None if there was
+    # nothing new
+    def train_incremental (self, image_files, results):
+        ledger = incremental.SeenLedger(self.seen_ledger)
+        initial = incremental.load_warm_start(self.warm_start, self.spec)
+        stamp = weight_cache.file_stamp(self.warm_start) if initial is not None else None
+        if not ledger.matches(stamp):
+            logger.warning("Seen ledger %s was written for %s, not %s: every picture is new" %
+                           (self.seen_ledger, str(ledger.model), str(stamp)))
+            ledger.reset()
+        if initial is None:
+            logger.info("No model in %s to warm start from, training on every picture" % self.warm_start)
+            new, replay = range(len(image_files)), []
+        else:
+            new, replay = incremental.select(image_files, results, ledger, self.replay_ratio)
+        if len(new) == 0:
+            logger.info("No new pictures since the last increment, %s" % str(ledger.stats()))
+            return None
+        logger.info("Increment of %d new and %d replayed pictures out of %d" %
+                    (len(new), len(replay), len(image_files)))
+        rows = sorted(new + replay)
+        files = [image_files[i] for i in rows]
+        labels = [results[i] for i in rows]
+        trained = self.train(files, labels, initial,
+                             meta={'warm_start': self.warm_start if initial is not None else None,
+                                   'new': len(new),
+                                   'replayed': len(replay)})
+        # only a saved model has seen them
+        if self.mat_file:
+            ledger.record(files, labels, image_files, self.mat_file, len(replay),
+                          weight_cache.file_stamp(self.mat_file))
+        return trained
+
+    # run the optimizer on the rows of imageMatrix (a matrix or a
+    # dataset.ChunkedDataset) from initial (Theta1, Theta2), or from random
+    # weights. returns the trained (Theta1, Theta2)
+    def fit (self, imageMatrix, resultsMatrix, iterations=max_iterations, initial=None):
+        input_layer_size = imageMatrix.shape[1]
+        if initial is not None:
+            Theta1, Theta2 = initial
+        else:
+            Theta1 = self.randInitializeWeights (input_layer_size, hidden_layer_size).T
+            Theta2 = self.randInitializeWeights (hidden_layer_size, output_layer_size).T
+            if self.optimizer in minibatch.OPTIMIZERS:
+                # drawn for the scaled inputs the mini-batches step on
+                Theta1[:,1:] *= minibatch_input_scale
         logger.debug("Theta_1 Matrix dimension: " + str(Theta1.shape))
         logger.debug("Theta_2 Matrix dimension: " + str(Theta2.shape))
 
         # unroll the initial NN parameters into an array
-        initial_nn_parameters = numpy.concatenate((Theta1.flatten('F'), Theta2.flatten('F')))
+        initial_nn_parameters = self.unroll(Theta1, Theta2)
 
         self.args = (imageMatrix, resultsMatrix)
-        thetas = optimize.fmin_cg(nnCostFunction, initial_nn_parameters, fprime=nnGradCostFunction, args=self.args, maxiter=max_iterations, callback=self.callbackIterationDone)
-        #thetas = initial_nn_parameters
+        if self.optimizer in minibatch.OPTIMIZERS:
+            return self.roll(self.fit_minibatch(initial_nn_parameters, imageMatrix, resultsMatrix),
+                             input_layer_size)
+        if isinstance(imageMatrix, dataset.ChunkedDataset):
+            self.objective = ChunkedCostGrad(imageMatrix, resultsMatrix)
+        else:
+            self.objective = CostGrad(imageMatrix, resultsMatrix)
+        self.iterCount = 1
+        # J and the gradient come from one pass (jac=True)
+        result = optimize.minimize(self.objective, initial_nn_parameters, jac=True, method=self.optimizer,
+                                   options={'maxiter': iterations}, callback=self.callbackIterationDone)
+        logger.debug("%s: %s, %d passes for %d iterations (%d remembered)" %
+                     (self.optimizer, result.message, self.objective.evaluations,
+                      self.iterCount - 1, self.objective.hits))
         # roll the theta together
-        border = hidden_layer_size*(input_layer_size+1)
-        _Theta1_ = numpy.reshape(thetas[0:border], (hidden_layer_size, input_layer_size+1), order='F')
-        _Theta2_ = numpy.reshape(thetas[border:], (output_layer_size, hidden_layer_size+1), order='F')
-        y = self.predict(_Theta1_, _Theta2_, imageMatrix)
-        accuracy = numpy.mean((y>0.5)==resultsMatrix)
-        logger.debug("Accuracy is about " + str(accuracy))
-        logger.info("Training NN completed")
+        return self.roll(result.x, input_layer_size)
+
+    # run the mini-batch optimizer for self.epochs from theta. Shuffled
+    # batches are streamed from imageMatrix (a ChunkedDataset is read a
+    # batch at a time). returns the trained theta
+    def fit_minibatch (self, theta, imageMatrix, resultsMatrix):
+        # fixed size steps don't get anywhere on the raw 0-255 pixels: they
+        # saturate the hidden layer, so its gradient vanishes. The batches
+        # (copies) are scaled as they are drawn and the scale is taken out of
+        # the input weights of Theta1 before and folded back in after, so
+        # theta (and the model) takes pixels
+        def cost_grad (theta, X, Y):
+            X *= minibatch_input_scale
+            return nnCostGradFunction(theta, X, Y)
+
+        # Theta1 is unrolled column by column, its bias column comes first
+        border = hidden_layer_size*(imageMatrix.shape[1]+1)
+        theta = numpy.array(theta, dtype=numpy.float64)
+        theta[hidden_layer_size:border] /= minibatch_input_scale
+        start = time_now()
+        losses = minibatch.train(theta, imageMatrix, resultsMatrix, cost_grad,
+                                 optimizer=self.optimizer, epochs=self.epochs, batch_size=self.batch_size,
+                                 rate=self.learning_rate, schedule=self.lr_schedule, decay=self.lr_decay,
+                                 step_epochs=self.lr_step, momentum=self.momentum)
+        self.iterCount = len(losses) + 1
+        logger.debug("%s: %d epochs of %d pictures in %.1f s, loss %.6f" %
+                     (self.optimizer, len(losses), imageMatrix.shape[0], time_now() - start,
+                      losses[-1] if losses else float('nan')))
+        theta[hidden_layer_size:border] *= minibatch_input_scale
+        return theta
+
+    # write the Thetas (and the projection they were trained on) to mat_file
+    # or, for a .model name, the float32 native model with the projection
+    # folded in and meta (training metadata) in its header
+    def save (self, Theta1, Theta2, proj=None, meta=None):
+        if not self.mat_file:
+            return
+        if self.mat_file.endswith(model_file.SUFFIX):
+            T1 = proj.fold(Theta1) if proj is not None else Theta1
+            meta = dict(meta or dict())
+            meta['trained'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            meta['path'] = self.img_path
+            engine = nn_engine.NNEngine.from_thetas(T1, Theta2, self.spec.shape)
+            model_file.save(self.mat_file, 'float32', engine.arrays(), self.spec, meta)
+            logger.info("Saved model to " + str(self.mat_file))
+            return
+        mat_vars = {'Theta1': Theta1, 'Theta2': Theta2}
+        if proj is not None:
+            mat_vars.update(proj.to_mat_vars())
+        # written aside and renamed into place like model_file.save, so the
+        # model registry and the seen ledger never stat a half written file.
+        # savemat gets a file object: given the name it appends .mat to it
+        tmp = self.mat_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            io.savemat(f, mat_vars)
+        os.rename(tmp, self.mat_file)
+        logger.info("Saved Thetas to " + str(self.mat_file))
+
+    # constructor keyword arguments from the trainer.Train_NN options
+    @staticmethod
+    def conf_kwargs (conf_vars):
+        return {'spec': ingest.FrameSpec.from_conf(conf_vars['roi'], conf_vars['roi_scale'], conf_vars['decode']),
+                'mat_file': conf_vars['mat_file'],
+                'projection': conf_vars['projection'],
+                'projection_k': conf_vars['projection_k'],
+                'projection_seed': conf_vars['projection_seed'],
+                'optimizer': conf_vars['optimizer'],
+                'feature_cache': conf_vars['feature_cache'],
+                'chunk_size': conf_vars['chunk_size'],
+                'epochs': conf_vars['epochs'],
+                'batch_size': conf_vars['batch_size'],
+                'learning_rate': conf_vars['learning_rate'],
+                'lr_schedule': conf_vars['lr_schedule'],
+                'lr_decay': conf_vars['lr_decay'],
+                'lr_step': conf_vars['lr_step'],
+                'momentum': conf_vars['momentum'],
+                'warm_start': conf_vars['warm_start'],
+                'replay_ratio': conf_vars['replay_ratio'],
+                'seen_ledger': conf_vars['seen_ledger']}
 
     @staticmethod
     def factory (conf_vars):
-        return Train_NN(conf_vars['path'])
-
+        return Train_NN(conf_vars['path'], **Train_NN.conf_kwargs(conf_vars))
+
+
+# seconds per optimizer iteration, on m random frames for each m in sizes:
+#   loop        fmin_cg, per sample loop gradient
+#   vectorized  fmin_cg, separate cost and vectorized gradient
+#   fused       minimize(jac=True) with CostGrad, for each method
+# and the largest difference of the loop and vectorized gradients relative
+# to the largest gradient. The loop is only timed up to loop_max frames, it
+# takes minutes per iteration beyond that
+def benchmark(sizes=(500, 5000), iterations=3, spec=ingest.DEFAULT_SPEC, loop_max=500):
+    columns = ['loop', 'vectorized'] + ['fused ' + method for method in OPTIMIZERS]
+    print "%8s" % 'frames' + "".join("%18s" % (name + ' s') for name in columns) + "%10s" % 'rel diff'
+    for m in sizes:
+        # built a row at a time, 5000 frames of float64 are already 2.8 GB
+        X = numpy.matrix(numpy.empty((m, spec.size), dtype=numpy.float64))
+        for row in range(m):
+            X[row] = numpy.random.randint(0, 256, spec.size)
+        Y = numpy.matrix(numpy.random.randint(0, 2, (m, 1)), dtype=numpy.float64)
+        # small weights, so the sigmoids don't saturate on random frames
+        theta = (numpy.random.random(hidden_layer_size*(spec.size+1) + output_layer_size*(hidden_layer_size+1)) - 0.5) * 1e-4
+
+        times = dict()
+        gradients = dict()
+        for name, fprime in (('loop', _nnGradCostFunctionLoop), ('vectorized', nnGradCostFunction)):
+            if name == 'loop' and m > loop_max:
+                continue
+            gradients[name] = fprime(theta, X, Y)
+            done = list()
+            start = time_now()
+            optimize.fmin_cg(nnCostFunction, theta, fprime=fprime, args=(X, Y), maxiter=iterations,
+                             callback=lambda xk: done.append(1), disp=False)
+            times[name] = (time_now() - start) / max(len(done), 1)
+        for method in OPTIMIZERS:
+            objective = CostGrad(X, Y)
+            done = list()
+            start = time_now()
+            optimize.minimize(objective, theta, jac=True, method=method, options={'maxiter': iterations},
+                              callback=lambda xk: done.append(objective.cost(xk)))
+            times['fused ' + method] = (time_now() - start) / max(len(done), 1)
+
+        diff = '-'
+        if 'loop' in gradients:
+            diff = "%.2e" % (numpy.max(numpy.abs(gradients['vectorized'] - gradients['loop'])) /
+                             numpy.max(numpy.abs(gradients['loop'])))
+        print "%8d" % m + "".join("%18s" % ("%.2f" % times[name] if name in times else '-') for name in columns) + \
+              "%10s" % diff
+
+def main():
+    parser = argparse.ArgumentParser(description='seconds per optimizer iteration of the training objective')
+    parser.add_argument('--sizes', nargs='*', type=int, default=[500, 5000], help='number of training frames')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--loop_max', type=int, default=500,
+                        help='largest number of frames the per sample loop is timed on')
+    parser.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX))
+    parser.add_argument('--roi_scale', type=int, default=1)
+    parser.add_argument('--decode', choices=ingest.DECODES, default='full',
+                           help='jpg decode (see ingest.py)')
+    args = parser.parse_args()
+    logging.setup(level='WARNING')
+    benchmark(args.sizes, args.iterations, ingest.FrameSpec(args.roi, args.roi_scale, args.decode), args.loop_max)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+#!/bin/python
+"""
+Watch mode: classify new frames as they land in a photo directory.
+
+On Linux the directory is watched with inotify (IN_CLOSE_WRITE and
+IN_MOVED_TO), so a frame is queued as soon as the camera has finished
+writing it or moved it in place. Without inotify the directory is scanned
+every scan_interval seconds for jpgs newer than the last one seen. If the
+inotify watcher stops on an error the directory is scanned from then on;
+if the directory itself is removed or unmounted the command exits.
+
+New frames go through a bounded FrameQueue: events for the same file are
+merged, and when classification falls behind the oldest frames are dropped
+first. One JSON line is printed per classified frame, like classifier.bulk.
+
+  python -m classifier.watch --day_model ThetasV7.mat --night_model NThetasV7.mat /data/pictures
+"""
+import common.log as logging
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from re import search
+from time import time, sleep
+
+import ingest
+import daylight
+import predict_NN
+
+logger = logging.getLogger()
+
+# inotify constants of <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# struct inotify_event without the name: wd, mask, cookie, len
+EVENT = struct.Struct('iIII')
+EVENT_BUFFER = 64 * (EVENT.size + 256)
+
+def is_picture(filename):
+    return search(r"(.+)\.jpg$", filename) is not None
+
+class FrameQueue (object):
+    '''
+    FrameQueue - bounded queue of frames waiting to be classified.
+
+    A frame that is already queued is not queued again (a burst of events
+    for one file is classified once). When capacity frames are waiting the
+    oldest one is dropped: for a camera the newest frames matter most.
+    get() waits for a first frame, then up to coalesce seconds for the
+    rest of a burst, and returns up to max_frames of them in arrival order.
+    '''
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.frames = OrderedDict()
+        self.cond = threading.Condition()
+        self.queued = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def put(self, filename):
+        with self.cond:
+            if filename in self.frames:
+                self.merged += 1
+                return
+            if len(self.frames) >= self.capacity:
+                old, queued = self.frames.popitem(last=False)
+                self.dropped += 1
+                logger.warning("Frame queue full, dropped " + old)
+            self.frames[filename] = time()
+            self.queued += 1
+            self.cond.notify()
+
+    # list of (filename, queued time). empty if nothing came within timeout
+    def get(self, max_frames=32, timeout=None, coalesce=0.05):
+        with self.cond:
+            end = None if timeout is None else time() + timeout
+            while len(self.frames) == 0:
+                left = None if end is None else end - time()
+                if left is not None and left <= 0:
+                    return []
+                self.cond.wait(left)
+            # let the rest of a burst arrive
+            end = time() + coalesce
+            while len(self.frames) < max_frames and time() < end:
+                self.cond.wait(end - time())
+            batch = list()
+            while len(self.frames) > 0 and len(batch) < max_frames:
+                batch.append(self.frames.popitem(last=False))
+            return batch
+
+    def __len__(self):
+        with self.cond:
+            return len(self.frames)
+
+    def stats(self):
+        with self.cond:
+            return {'waiting': len(self.frames), 'queued': self.queued,
+                    'merged': self.merged, 'dropped': self.dropped}
+
+def _libc():
+    name = ctypes.util.find_library('c')
+    if name is None:
+        raise OSError(errno.ENOSYS, "no libc")
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, "no inotify")
+    return libc
+
+# jpgs of dirname modified at or after since, oldest first
+def scan(dirname, since):
+    found = list()
+    for name in os.listdir(dirname):
+        if not is_picture(name):
+            continue
+        path = os.path.join(dirname, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if mtime >= since:
+            found.append((mtime, path))
+    return sorted(found)
+
+class InotifyWatcher (object):
+    '''
+    InotifyWatcher - queues the jpgs written or moved into dirname.
+
+    Raises OSError if inotify is not available. If the kernel event queue
+    overflows, the directory is scanned for what was missed since the last
+    event.
+    '''
+    def __init__(self, dirname, queue):
+        self.dirname = dirname
+        self.queue = queue
+        self.libc = _libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1: " + os.strerror(err))
+        wd = self.libc.inotify_add_watch(self.fd, dirname, IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch %s: %s" % (dirname, os.strerror(err)))
+        self.last_event = time()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.fd)
+
+    # False once the thread stopped on its own (see watch)
+    def alive(self):
+        return self.running and self.thread is not None and self.thread.is_alive()
+
+    def _events(self, data):
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip('\0')
+            offset += EVENT.size + length
+            yield mask, name
+
+    def run(self):
+        while self.running:
+            # wake up now and then to see if we're stopped
+            ready = select.select([self.fd], [], [], 0.5)[0]
+            if not ready:
+                continue
+            try:
+                data = os.read(self.fd, EVENT_BUFFER)
+            except OSError as ex:
+                if ex.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            for mask, name in self._events(data):
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflow, scanning " + self.dirname)
+                    for mtime, path in scan(self.dirname, self.last_event - 1.0):
+                        self.queue.put(path)
+                elif mask & IN_IGNORED:
+                    logger.error("Watched directory is gone: " + self.dirname)
+                    self.running = False
+                elif is_picture(name):
+                    self.queue.put(os.path.join(self.dirname, name))
+            self.last_event = time()
+
+class ScanWatcher (object):
+    '''
+    ScanWatcher - queues new jpgs of dirname by scanning it.
+
+    Every interval seconds the directory is listed and the jpgs with an mtime
+    past the watermark (the newest mtime queued so far) are queued. A file is
+    only queued once its mtime is settle seconds old, so a frame still being
+    written is picked up on a later scan.
+    '''
+    def __init__(self, dirname, queue, interval=2.0, settle=1.0):
+        self.dirname = dirname
+        self.queue = queue
+        self.interval = interval
+        self.settle = settle
+        self.watermark = time()
+        # files queued with an mtime equal to the watermark
+        self.at_watermark = set()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    # False once the thread stopped on its own (see watch)
+    def alive(self):
+        return self.running and self.thread is not None and self.thread.is_alive()
+
+    def poll(self):
+        limit = time() - self.settle
+        for mtime, path in scan(self.dirname, self.watermark):
+            if mtime > limit:
+                break
+            if mtime == self.watermark and path in self.at_watermark:
+                continue
+            if mtime > self.watermark:
+                self.watermark = mtime
+                self.at_watermark = set()
+            self.at_watermark.add(path)
+            self.queue.put(path)
+
+    def run(self):
+        while self.running:
+            try:
+                self.poll()
+            except OSError as ex:
+                logger.error("Scan failed: " + str(ex))
+            sleep(self.interval)
+
+# an inotify watcher of dirname, or a scanning one where inotify is not
+# available. Not started
+def watcher(dirname, queue, scan_interval=2.0):
+    try:
+        return InotifyWatcher(dirname, queue)
+    except (OSError, AttributeError) as ex:
+        logger.warning("inotify not available (%s), scanning every %g s" % (str(ex), scan_interval))
+        return ScanWatcher(dirname, queue, scan_interval)
+
+# a started scanning watcher to carry on with once source stopped on its own
+# (an inotify error, or the watched directory was removed or unmounted).
+# Raises OSError if the directory is gone
+def fallback(source, dirname, queue, scan_interval=2.0):
+    if not os.path.isdir(dirname):
+        raise OSError(errno.ENOENT, "Watched directory is gone: " + dirname)
+    source.stop()
+    logger.error("%s stopped, scanning %s every %g s" % (type(source).__name__, dirname, scan_interval))
+    scanner = ScanWatcher(dirname, queue, scan_interval)
+    # pick up what landed since the last event; a frame queued twice is
+    # classified twice, a missed one never
+    scanner.watermark = getattr(source, 'last_event', scanner.watermark) - 1.0
+    scanner.start()
+    return scanner
+
+# classify the frames landing in dirname with predicter until interrupted.
+# every result is written as a JSON line to out. Raises OSError if the
+# directory goes away
+def watch(predicter, dirname, out=sys.stdout, capacity=256, coalesce=0.05, scan_interval=2.0):
+    queue = FrameQueue(capacity)
+    source = watcher(dirname, queue, scan_interval)
+    source.start()
+    logger.info("Watching " + dirname)
+    try:
+        while True:
+            for filename, queued in queue.get(timeout=1.0, coalesce=coalesce):
+                try:
+                    result = predicter.predict(filename)
+                except (IOError, ValueError) as ex:
+                    # a truncated or corrupt frame must not stop the watch
+                    logger.error("Classify failed: %s: %s" % (filename, str(ex)))
+                    record = {'file': filename, 'error': str(ex)}
+                else:
+                    if result is None:
+                        record = {'file': filename, 'error': 'not classified'}
+                    else:
+                        record = {'file': filename,
+                                  'closed': bool(result[0]),
+                                  'confidence': float(result[1]),
+                                  'version': getattr(result, 'version', None)}
+                        if getattr(result, 'skipped', None) is not None:
+                            record['skipped'] = result.skipped
+                record['latency_ms'] = round((time() - queued) * 1000.0, 1)
+                out.write(json.dumps(record, sort_keys=True) + '\n')
+                out.flush()
+            if not source.alive():
+                source = fallback(source, dirname, queue, scan_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.stop()
+        logger.info("frame queue: " + str(queue.stats()))
+
+def main():
+    parser = argparse.ArgumentParser(description='classify new pictures as they land in a directory')
+    parser.add_argument('dirname')
+    parser.add_argument('--day_model', required=True, help='model file or models directory')
+    parser.add_argument('--night_model', default=None, help='defaults to the day model')
+    parser.add_argument('--out', default=None, help='append the JSON lines to this file instead of stdout')
+    parser.add_argument('--queue_size', type=int, default=256, help='frames waiting before the oldest is dropped')
+    parser.add_argument('--coalesce', type=float, default=0.05, help='seconds to wait for the rest of a burst')
+    parser.add_argument('--scan_interval', type=float, default=2.0, help='seconds between scans without inotify')
+    parser.add_argument('--change_threshold', type=float, default=0.0,
+                        help='reuse the last result while the scene changes less than this many grey levels (0 is off)')
+    parser.add_argument('--weight_mode', choices=sorted(predict_NN.ENGINE_LOADERS.keys()), default='float32')
+    parser.add_argument('--roi', nargs=4, type=int, default=list(ingest.CROP_BOX),
+                        help='roi the model was trained on: left upper right lower')
+    parser.add_argument('--roi_scale', type=int, default=1)
+    parser.add_argument('--decode', choices=ingest.DECODES, default='full',
+                           help='jpg decode the model was trained on')
+    parser.add_argument('--latitude', type=float, default=None)
+    parser.add_argument('--longitude', type=float, default=None)
+    args = parser.parse_args()
+
+    # the log goes to stdout too, keep it quiet when the results do
+    logging.setup(level='INFO' if args.out else 'WARNING')
+    if not os.path.isdir(args.dirname):
+        print "directory does not exist"
+        sys.exit(1)
+    predicter = predict_NN.Predicter_NN(args.day_model, args.night_model or args.day_model,
+                                        weight_mode=args.weight_mode,
+                                        spec=ingest.FrameSpec(args.roi, args.roi_scale, args.decode),
+                                        change_threshold=args.change_threshold,
+                                        daylight_oracle=daylight.DaylightOracle(args.latitude, args.longitude))
+    out = open(args.out, 'a') if args.out else sys.stdout
+    try:
+        watch(predicter, args.dirname, out, args.queue_size, args.coalesce, args.scan_interval)
+    except OSError as ex:
+        logger.error(str(ex))
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
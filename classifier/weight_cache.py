@@ -0,0 +1,213 @@
+import common.log as logging
+import hashlib
+import os
+import threading
+from re import findall
+from time import time as now, strftime, localtime
+from projection import Projection
+
+logger = logging.getLogger()
+
+# files a models directory may hold. anything else (e.g. the .tmp files of
+# a model being written) is ignored
+MODEL_EXTENSIONS = ('.mat', '.model', '.npz')
+
+# load the Theta1/Theta2 pair out of a mat file. A model trained on
+# projected features has its projection folded back into Theta1
+def load_thetas(filename):
+    # only needed for mat files, native models don't pull scipy.io in
+    from scipy import io
+    x = io.loadmat(filename, None, False)
+    Theta1 = x['Theta1']
+    proj = Projection.from_mat_vars(x)
+    if proj is not None:
+        Theta1 = proj.fold(Theta1)
+    return (Theta1, x['Theta2'])
+
+# the model file a location stands for. A file is itself; in a directory
+# the newest version wins: the highest number in the name (ThetasV8.mat
+# over ThetasV7.mat, model-0012.model over model-0011.model), then the
+# latest mtime. None if there is no model
+def resolve(location):
+    if not os.path.isdir(location):
+        return location
+    candidates = list()
+    for name in os.listdir(location):
+        path = os.path.join(location, name)
+        if os.path.splitext(name)[1] not in MODEL_EXTENSIONS or not os.path.isfile(path):
+            continue
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        candidates.append(([int(x) for x in findall(r"\d+", name)], mtime, path))
+    if len(candidates) == 0:
+        return None
+    return max(candidates)[2]
+
+# (path, mtime, size) of the model a location stands for or None if it
+# cannot be stat'ed
+def file_stamp(location):
+    filename = resolve(location)
+    if filename is None:
+        return None
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (filename, st.st_mtime, st.st_size)
+
+# printable version of a stamp: file name, modification time to the
+# microsecond and a hash of the whole stamp. A model rewritten within the
+# same second, or a file of the same name in another directory, gets its
+# own version (results are cached per version, see result_cache.py)
+def stamp_version(stamp):
+    path, mtime, size = stamp
+    digest = hashlib.sha1(repr((os.path.abspath(path), mtime, size))).hexdigest()[:8]
+    return "%s@%s.%06d-%s" % (os.path.basename(path), strftime('%Y%m%d_%H%M%S', localtime(mtime)),
+                              int((mtime - int(mtime)) * 1000000), digest)
+
+class Model (object):
+    '''
+    Model - one loaded version of a model file.
+
+    weights is whatever the loader returned (an inference engine for the
+    predicters) and version names the file and mtime it came from. A Model
+    is never changed after it is made, so a caller holding one keeps using
+    the same weights and version however often the cache is swapped.
+    '''
+    def __init__(self, weights, version, filename):
+        self.weights = weights
+        self.version = version
+        self.filename = filename
+        self.loaded = now()
+
+class WeightCache (object):
+    '''
+    WeightCache - keeps one model file resident in memory.
+
+    location is a model file, or a directory of versioned model files of
+    which the newest is used (see resolve). The model is loaded once when
+    the cache is created. get_model() hands back the loaded Model without
+    touching the disk; at most every check_interval seconds it stats the
+    location and, if the model changed, loads the new one on a background
+    thread. The new weights are passed to validate (which raises on a bad
+    model) before they replace the current Model in one assignment; frames
+    already running keep the Model they started with, and a model that
+    fails to load or validate is never switched to.
+    '''
+    def __init__(self, filename, loader=load_thetas, check_interval=10, validate=None):
+        self.filename = filename
+        self.loader = loader
+        self.check_interval = check_interval
+        self.validate = validate
+        self.current = None
+        self.stamp = None
+        self.last_check = 0.0
+        self.lock = threading.Lock()
+        self.reloading = False
+        self.swaps = 0
+        self.load()
+
+    @property
+    def weights(self):
+        model = self.current
+        return model.weights if model is not None else None
+
+    @property
+    def version(self):
+        model = self.current
+        return model.version if model is not None else None
+
+    # synchronous load. Returns True if the weights were replaced
+    def load(self):
+        stamp = file_stamp(self.filename)
+        if stamp is None:
+            logger.error("Load mat failed, no model at " + str(self.filename))
+            return False
+        try:
+            weights = self.loader(stamp[0])
+            if self.validate is not None:
+                self.validate(weights)
+        except Exception as ex:
+            logger.error("Load mat failed: " + str(stamp[0]))
+            logger.debug(ex)
+            # don't retry until the file changes again
+            with self.lock:
+                self.stamp = stamp
+            return False
+        model = Model(weights, stamp_version(stamp), stamp[0])
+        with self.lock:
+            previous = self.current
+            self.current = model
+            self.stamp = stamp
+            if previous is not None:
+                self.swaps += 1
+        if previous is None:
+            logger.info("Loaded model %s" % model.version)
+        else:
+            logger.info("Switched model %s -> %s" % (previous.version, model.version))
+        return True
+
+    def _reload(self):
+        try:
+            self.load()
+        finally:
+            with self.lock:
+                self.reloading = False
+
+    # cheap check of the model stamp. start a background reload if it changed
+    def check(self):
+        self.last_check = now()
+        stamp = file_stamp(self.filename)
+        if stamp is None or stamp == self.stamp:
+            return
+        with self.lock:
+            if self.reloading:
+                return
+            self.reloading = True
+        logger.debug("Model changed, reloading " + str(stamp[0]))
+        thread = threading.Thread(target=self._reload)
+        thread.daemon = True
+        thread.start()
+
+    # the current Model (None if none loaded). Take it once per frame or
+    # batch and use its weights and version together
+    def get_model(self):
+        if now() - self.last_check >= self.check_interval:
+            self.check()
+        return self.current
+
+    def get(self):
+        model = self.get_model()
+        return model.weights if model is not None else None
+
+class ModelRegistry (object):
+    '''
+    ModelRegistry - the WeightCaches of a process.
+
+    Predicters ask the registry for their models, so two predicters that
+    use the same location and loader (e.g. a cascade stage and the manager's
+    own Predicter_NN) share one resident copy and one watcher.
+    '''
+    def __init__(self):
+        self.caches = dict()
+        self.lock = threading.Lock()
+
+    # WeightCache of location. key tells apart loaders that build different
+    # weights from the same file (weight_mode, frame spec)
+    def cache(self, location, key=None, loader=load_thetas, check_interval=10, validate=None):
+        with self.lock:
+            cache = self.caches.get((location, key))
+            if cache is None:
+                cache = WeightCache(location, loader, check_interval, validate)
+                self.caches[(location, key)] = cache
+            return cache
+
+    # location -> active version of every model, for monitoring
+    def versions(self):
+        with self.lock:
+            caches = self.caches.items()
+        return dict((location, cache.version) for (location, key), cache in caches)
+
+REGISTRY = ModelRegistry()
@@ -81,6 +81,9 @@ class Opt (object):
         return None
 
     def _set_ (self, value):
+        # an option that was not given keeps its None default
+        if value is None and self.value is None:
+            return
         if type(value) == self.type:
             self.value = value
         else:
@@ -129,6 +132,14 @@ class IntOpt(Opt):
     def _get_ (self):
         return self.value
 
+class FloatOpt(Opt):
+    def __init__ (self, group='app', name=None, short=None, default=None, help=None, sub_group=''):
+        super(FloatOpt,self).__init__(group, name, short, default, help, sub_group)
+        self.type = FloatType
+
+    def _get_ (self):
+        return self.value
+
 class StrOpt(Opt):
     def __init__ (self, group='app', name=None, short=None, default=None, help=None, sub_group=''):
         super(StrOpt,self).__init__(group, name, short, default, help, sub_group)
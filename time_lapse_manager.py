@@ -2,6 +2,8 @@ import common.log as logging
 #from camera.camera import WebCam
 #from camera.camera import CameraException
 import camera.camera_manager as cameraManager
+import classifier.prediction_manager as predictionManager
+import classifier.executor as classifierExecutor
 import ConfigParser
 import common.config as Conf
 import os
@@ -44,6 +46,30 @@ Options = [
                  group   = 'app',
                  default = ['fswebcam'],
                  help    = 'name of camera to use (options are fswebcam)'),
+    Conf.ListOpt(name    = 'classifier',
+                 group   = 'app',
+                 default = ['Predicter_NN'],
+                 help    = 'name of classifiers to set up (options are Predicter_NN, Predicter_Brightness)'),
+    Conf.ListOpt(name    = 'trainer',
+                 group   = 'app',
+                 default = [],
+                 help    = 'name of trainers to set up (options are Train_NN)'),
+    Conf.ListOpt(name    = 'cascade',
+                 group   = 'app',
+                 default = [],
+                 help    = 'classifiers evaluated as a cascade, cheapest first. empty disables the cascade'),
+    Conf.ListOpt(name    = 'cascade_band',
+                 group   = 'app',
+                 default = ['0.1', '0.9'],
+                 help    = 'uncertainty band (low high) of the cascade stages. one pair for all stages or one pair per stage'),
+    Conf.IntOpt(name    = 'classifier_workers',
+                group   = 'app',
+                default = 0,
+                help    = 'number of OS threads (or processes) classifying the captured frames off the main loop. 0 does not classify captures'),
+    Conf.StrOpt(name    = 'classifier_pool',
+                group   = 'app',
+                default = 'thread',
+                help    = 'where captured frames are classified. options are: thread (eventlet tpool), process (forked workers)'),
     Conf.FileOpt(name    = 'log_file',
                  group   = 'app',
                  default = None,
@@ -73,12 +99,34 @@ class TimeLapseManager (object):
         self.config = None
         self.photo_file = CONF.importOpt(module='time_lapse_manager', name='photo_file', group='app')
         self.trainingDone = False
+        self.prediction_manager = None
+        self.executor = None
 
     def pre_hook (self):
         self.camera_manager.setup()
         camera_name= CONF.importOpt(module='time_lapse_manager', name='camera', group='app')
         self.camera = self.camera_manager.get_camera(camera_name[0])
 
+        workers = CONF.importOpt(module='time_lapse_manager', name='classifier_workers', group='app')
+        if workers > 0:
+            self.prediction_manager = predictionManager.PredictionManager()
+            self.prediction_manager.setup()
+            pool = CONF.importOpt(module='time_lapse_manager', name='classifier_pool', group='app')
+            self.executor = classifierExecutor.ClassificationExecutor(self.prediction_manager.predict, workers, pool)
+
+    # called on the main loop when a captured frame has been classified
+    def classified (self, gt, filename):
+        try:
+            result = gt.wait()
+        except Exception as ex:
+            logger.error("Classify failed: " + filename)
+            logger.debug(ex)
+            return
+        if result is None:
+            return
+        logger.info("%s %s (%s) [%s]" % (filename, 'closed' if result[0] else 'opened',
+                                         str(result[1]), str(getattr(result, 'version', None))))
+
 # main run loop for the application
 #
 
@@ -91,5 +139,8 @@ class TimeLapseManager (object):
                 filename = self.camera.capture(self.photo_file)
                 if filename is not None:
                     logger.debug("filename = "  + filename + "\n")
+                    if self.executor is not None:
+                        # classified off the hub, so the timers keep running
+                        self.executor.submit(filename).link(self.classified, filename)
             except CameraException as ex:
                 logger.info(ex.reason)